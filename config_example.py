@@ -44,10 +44,39 @@ else:
     ANNO_DIR = os.sep.join([KRSL_DIR, "annotation"])
 
 VIDEOS_DIR = os.path.join(GEN_DATA_DIR, "END2END_VIDEOS")
+# processes converting the source datasets into VIDEOS_DIR (reformat_datasets.py), None => one per core
+REFORMAT_WORKERS = None
+
+# PHOENIX frames: "video" => videos converted by convert_phoenix_to_videos, "png" => the original png folders,
+# read directly (no conversion, lossless) with PNG_READ_THREADS threads per video
+PH_FRAME_BACKEND = "video"
+PNG_READ_THREADS = 8
+# codec and container of converted PHOENIX videos, "FFV1" and ".mkv" => lossless
+PH_VIDEO_FOURCC = "mp4v"
+PH_VIDEO_EXT = ".mp4"
+
+# decoded uint8 frames of every split (and of the GR videos), resized to the STF input size
+# and packed into one memory-mapped file, see feature_extraction/frame_store.py
+USE_FRAME_STORE = False
+FRAME_STORE_DIR = os.path.join(GEN_DATA_DIR, "FRAME_STORE")
 
 FEAT_OVERRIDE = True
 USE_ST_FEAT = True
 
+# pack each split's features into one memory-mapped file (see packed_store.py), optionally stored as float16
+FEAT_PACKED = True
+FEAT_PACKED_FP16 = True
+
+# feature extraction pipeline (see feature_extraction/pipeline.py): decoding processes (None => one per core),
+# clips decoded ahead of the model, max frames per model forward (several videos are batched up to it)
+FEAT_DECODE_WORKERS = None
+FEAT_DECODE_DEPTH = 16
+FEAT_FRAME_BUDGET = 256
+# inference of STF_2Plus1D over long videos in windows of STF_WINDOW frames (+ context), None => whole video at once
+STF_WINDOW = 128
+# per-shard journals of finished feature files, a killed (sharded) extraction resumes from them
+FEAT_JOURNAL_DIR = os.path.join(GEN_DATA_DIR, "FEAT_JOURNALS")
+
 # Spatio temporal Feature Extractor models
 # STF_MODEL = "densenet121"
 # STF_MODEL = "googlenet"
@@ -89,11 +118,44 @@ else:
 
 END2END_N_EPOCHS = 100
 
+# processes reading feature/video lengths when building End2End dataset manifests, None => one per core
+MANIFEST_WORKERS = None
+
 END2END_STF_BATCH_SIZE = 1024
 END2END_RAW_BATCH_SIZE = 4
+# ST feature batches group videos of nearby lengths (zero padded) up to this many padded frames,
+# raw video and image feature batches hold videos of one length (the STF convolutions would see the padding)
+END2END_STF_FRAME_BUDGET = 32768
+# processes decoding and preprocessing raw clips into a shared memory batch, None => one per core, 1 => serial
+END2END_RAW_WORKERS = None
 
 END2END_LR = 0.0001
 
+# batches are assembled in background workers, up to END2END_PREFETCH_DEPTH batches ahead
+# (END2END_PREFETCH_WORKERS = 0 => no prefetching, processes instead of threads for heavy python augmentation)
+END2END_PREFETCH_DEPTH = 4
+END2END_PREFETCH_WORKERS = 2
+END2END_PREFETCH_PROCESSES = False
+
+# CTC decoding of the predictions: None => greedy, "beam" => prefix beam search (decoder.py)
+# with an n-gram gloss LM trained on the train annotations (LM_ORDER = 0 => no LM)
+END2END_DECODER = None
+BEAM_WIDTH = 10
+BEAM_PRUNE_TH = 0.001  # labels below this probability at a step don't extend the beams
+BEAM_TOP_N = 16  # nor more than this many labels per step
+LM_ORDER = 3
+LM_ALPHA = 0.5  # LM weight
+LM_BETA = 1.0  # bonus per gloss
+DECODER_WORKERS = None  # decoding processes, None => one per core, 1 => in the main process
+
+# log probabilities of every utterance, per model weights, cached for reevaluation, decoding and GR labelling
+# (emissions.py, float16 => 2 bytes * output steps * vocabulary size per utterance)
+EMISSION_CACHE = True
+EMISSION_CACHE_DIR = os.path.join(GEN_DATA_DIR, "EMISSIONS")
+
+# every new best val checkpoint writes the dev .ctm and scores it against the PHOENIX .stm (wer.py)
+END2END_SCORE_CHECKPOINTS = False
+
 # Augmentation constants
 END2END_DATA_AUG_TEMP = True
 END2END_DATA_AUG_FRAME = True
@@ -104,6 +166,8 @@ DOWN_SAMPLE_FACTOR = 0.3
 GR_BATCH_SIZE = 4
 GR_LR = 0.00005
 GR_N_EPOCHS = 10
+# utterances whose features are labelled (CTC forced alignment) together when generating the GR dataset
+GR_ALIGN_BATCH_SIZE = 32
 ########################################################################################################################
 N_ITER = 6
 END2END_STOP_LIMIT = 10
@@ -3,17 +3,24 @@ from dataset.end2end_base import End2EndDataset
 from dataset.end2end_img_feat import End2EndImgFeatDataset
 from dataset.end2end_stf import End2EndSTFDataset
 from dataset.end2end_raw import End2EndRawDataset
+from dataset.prefetch import BatchPrefetcher
 
 from config import *
 
 
-def get_end2end_datasets(model, vocab, include_test=False, load=True):
+def get_end2end_dataset(model, vocab, split, load=True):
+    # dataset of one split matching the model's input (ST features, image features or raw videos),
+    # augmentation only applies to the train split.
+    # Only ST features are batched with padding: the STF temporal convolutions of the other inputs would mix the
+    # padding into the last valid steps (and the BatchNorm statistics), their batches hold videos of one length
     if model.use_st_feat or model.use_img_feat:
         batch_size = END2END_STF_BATCH_SIZE
     else:
         batch_size = END2END_RAW_BATCH_SIZE
 
-    args = {"vocab": vocab, "split": "train", "max_batch_size": batch_size,
+    frame_budget = END2END_STF_FRAME_BUDGET if model.use_st_feat else None
+
+    args = {"vocab": vocab, "split": split, "max_batch_size": batch_size, "frame_budget": frame_budget,
             "augment_temp": END2END_DATA_AUG_TEMP, "augment_frame": END2END_DATA_AUG_FRAME, "load": load}
 
     if model.use_st_feat:
@@ -23,14 +30,14 @@ def get_end2end_datasets(model, vocab, include_test=False, load=True):
     else:
         dataset_class = End2EndRawDataset
 
-    tr_dataset = dataset_class(**args)
-    args["split"] = "dev"
-    val_dataset = dataset_class(**args)
+    return dataset_class(**args)
 
-    datasets = {"train": tr_dataset, "val": val_dataset}
+
+def get_end2end_datasets(model, vocab, include_test=False, load=True):
+    datasets = {"train": get_end2end_dataset(model, vocab, "train", load),
+                "val": get_end2end_dataset(model, vocab, "dev", load)}
     if include_test:
-        args["split"] = "test"
-        datasets["test"] = dataset_class(**args)
+        datasets["test"] = get_end2end_dataset(model, vocab, "test", load)
 
     return datasets
 
@@ -1,43 +1,50 @@
-import pickle
+import time
 import torch
 import numpy as np
 import sys
+from multiprocessing import Pool
 
 sys.path.append("..")
 from config import *
 from utils import get_split_df, ProgressPrinter
+from packed_store import open_packed_store, packed_store_exists
+from dataset.manifest import manifest_exists, load_manifest, save_manifest, get_file_stat, RaggedArray
 
 
-def down_sample(video, n):
-    video = [video[int(i)] for i in np.linspace(0, len(video) - 1, n)]
-    return video
-
+_manifest_dataset = None
 
-def random_skip(video, skipped_idxs):
-    res_video = []
 
-    for i in range(len(video)):
-        if skipped_idxs and i == skipped_idxs[0]:
-            skipped_idxs.pop(0)
-            continue
+def _init_manifest_worker(dataset):
+    global _manifest_dataset
+    _manifest_dataset = dataset
 
-        res_video.append(video[i])
 
-    return res_video
+def _manifest_worker(feat_path):
+    return _manifest_dataset._get_feat_len(feat_path)
 
 
-def crop_video(video):
+def crop_video(video, rng=np.random):
     cropped_video = []
     for img in video:
         h, w = img.shape[:2]
-        y1, x1 = int(0.2 * np.random.rand() * h), int(0.2 * np.random.rand() * h)
-        y2, x2 = h - int(0.2 * np.random.rand() * h), w - int(0.2 * np.random.rand() * h)
+        y1, x1 = int(0.2 * rng.rand() * h), int(0.2 * rng.rand() * h)
+        y2, x2 = h - int(0.2 * rng.rand() * h), w - int(0.2 * rng.rand() * h)
         img = img[y1:y2, x1:x2]
         cropped_video.append(img)
 
     return cropped_video
 
 
+def pad_batch(videos):
+    # (B, T_max, ...) float tensor of variable length videos, zero padded at the end of the time axis
+    T = max(len(video) for video in videos)
+    X_batch = torch.zeros((len(videos), T) + tuple(videos[0].shape[1:]))
+    for idx, video in enumerate(videos):
+        X_batch[idx, :len(video)] = torch.as_tensor(video)
+
+    return X_batch
+
+
 def noise_video(video):
     video = video.astype(np.float32)
     video += 2 - 4 * np.random.rand(*video.shape)
@@ -50,7 +57,8 @@ def noise_video(video):
 
 
 class End2EndDataset():
-    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True):
+    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True,
+                 frame_budget=None):
         if split == "train":
             self.augment_temp = augment_temp
             self.augment_frame = augment_frame
@@ -59,6 +67,8 @@ class End2EndDataset():
             self.augment_frame = False
 
         self.max_batch_size = max_batch_size
+        # max number of (padded) frames in a batch, None => batches of videos of one length (no padding)
+        self.frame_budget = frame_budget
         self.load = load
 
         if SOURCE == "PH" and split == "val":
@@ -69,11 +79,47 @@ class End2EndDataset():
 
         self.split = split
         self.vocab = vocab
+        self._open_store()
         self._build_dataset()
 
-    def _get_feat(self, row, glosses=None):
+    def _get_feat_path(self, row):
         raise NotImplementedError
 
+    def _get_feat_len(self, feat_path):
+        # length from metadata only (file headers, store index), None if the file is unusable
+        raise NotImplementedError
+
+    def _get_feat_stat(self, feat_path):
+        stat = get_file_stat(feat_path)
+        if stat is None and self.store is not None and feat_path in self.store:
+            # only packed, the store itself is the source
+            return 0, 0.0
+
+        return stat
+
+    def _get_store_path(self):
+        return None
+
+    @property
+    def store_path(self):
+        # packed store of the split's features/frames (None => per-file loads), whether it exists or not
+        return self._get_store_path()
+
+    def _open_store(self):
+        store_path = self._get_store_path()
+        if store_path is not None and packed_store_exists(store_path):
+            self.store = open_packed_store(store_path)
+            print(self.split[0].upper() + self.split[1:], "packed store opened:", store_path)
+        else:
+            self.store = None
+
+    def _load_video(self, i):
+        # zero-copy view over the packed memory map when available
+        if self.store is not None and self.X[i] in self.store:
+            return self.store.get_tensor(self.X[i])
+
+        return torch.load(self.X[i])
+
     def _show_progress(self):
         return False
 
@@ -81,102 +127,164 @@ class End2EndDataset():
         return STF_MODEL + "_" + str(IMG_FEAT_SIZE)
 
     def _build_dataset(self):
-
         dataset_dir = os.sep.join([END2END_DATASETS_DIR, self._get_ffm()])
 
-        X_path = os.sep.join([dataset_dir, "X_" + self.split + ".pkl"])
-        Y_path = os.sep.join([dataset_dir, "Y_" + self.split + ".pkl"])
-        X_lens_path = os.sep.join([dataset_dir, "X_lens_" + self.split + ".pkl"])
-
-        if os.path.exists(X_path) and os.path.exists(Y_path) and os.path.exists(X_lens_path) and self.load:
-            with open(X_path, 'rb') as f:
-                self.X = pickle.load(f)
-
-            with open(Y_path, 'rb') as f:
-                self.Y = pickle.load(f)
-
-            with open(X_lens_path, 'rb') as f:
-                self.X_lens = pickle.load(f)
-
+        if self.load and manifest_exists(dataset_dir, self.split):
+            rows, Y_flat = load_manifest(dataset_dir, self.split)
             print(self.split[0].upper() + self.split[1:], "dataset loaded")
         else:
-            print("Building", self.split, "dataset")
-            df = get_split_df(self.split)
-            self.X = []
-            self.Y = []
-            self.X_lens = []
-
-            pp = ProgressPrinter(df.shape[0], 5)
-            for idx in range(df.shape[0]):
-                row = df.iloc[idx]
-                glosses = self.vocab.encode(row.annotation)
-                feat_path, feat, feat_len = self._get_feat(row, glosses)
-                if feat is None:
-                    continue
-
-                self.X.append(feat_path)
-                self.Y.append(glosses)
-                self.X_lens.append(feat_len)
-
-                if self._show_progress():
-                    pp.show(idx)
+            self._update_manifest(dataset_dir)
+            rows, Y_flat = load_manifest(dataset_dir, self.split)
+
+        self.length = len(rows)
+        self.X = rows["path"]
+        self.X_lens = rows["len"]
+        self.Y_lens = rows["y_len"]
+        self.Y = RaggedArray(Y_flat, rows["y_offset"], self.Y_lens)
+
+    def _update_manifest(self, dataset_dir):
+        # rows whose file size and mtime match the previous manifest keep their length, others are read again
+        print("Updating", self.split, "dataset")
+        start_time = time.time()
+        df = get_split_df(self.split)
+
+        known = {}
+        if manifest_exists(dataset_dir, self.split):
+            old_rows = load_manifest(dataset_dir, self.split)[0]
+            for row in old_rows:
+                known[str(row["path"])] = (row["size"], row["mtime"], row["len"])
+
+        paths = []
+        stats = []
+        glosses = []
+        lens = []
+        to_read = []
+        for idx in range(df.shape[0]):
+            row = df.iloc[idx]
+            feat_path = self._get_feat_path(row)
+            stat = self._get_feat_stat(feat_path)
+            if stat is None:
+                continue
+
+            if feat_path in known and known[feat_path][:2] == stat:
+                lens.append(known[feat_path][2])
+            else:
+                lens.append(None)
+                to_read.append(len(paths))
+
+            paths.append(feat_path)
+            stats.append(stat)
+            glosses.append(self.vocab.encode(row.annotation))
+
+        if to_read:
+            pp = ProgressPrinter(len(to_read), 5)
+            with Pool(MANIFEST_WORKERS, initializer=_init_manifest_worker, initargs=(self,)) as pool:
+                read_paths = [paths[k] for k in to_read]
+                for idx, feat_len in enumerate(pool.imap(_manifest_worker, read_paths, chunksize=8)):
+                    lens[to_read[idx]] = feat_len
+                    if self._show_progress():
+                        pp.show(idx)
 
             if self._show_progress():
                 pp.end()
 
-            if not os.path.exists(dataset_dir):
-                os.makedirs(dataset_dir)
+        valid = [k for k in range(len(paths))
+                 if lens[k] is not None and self._get_aug_diff(lens[k], len(glosses[k])) >= 0]
 
-            with open(X_path, 'wb') as f:
-                pickle.dump(self.X, f)
+        save_manifest(dataset_dir, self.split,
+                      [paths[k] for k in valid],
+                      [stats[k][0] for k in valid],
+                      [stats[k][1] for k in valid],
+                      [lens[k] for k in valid],
+                      [glosses[k] for k in valid])
 
-            with open(Y_path, 'wb') as f:
-                pickle.dump(self.Y, f)
+        build_time = time.time() - start_time
+        print(self.split[0].upper() + self.split[1:], "dataset updated:", len(valid), "videos,",
+              len(paths) - len(to_read), "unchanged,", len(to_read), "read", "in %.1fs" % build_time,
+              "(%.1f videos/s)" % (len(to_read) / max(build_time, 1e-6)))
 
-            with open(X_lens_path, 'wb') as f:
-                pickle.dump(self.X_lens, f)
+    def start_epoch(self, shuffle=True):
+        self.X_aug_lens, self.X_aug_offsets, self.X_aug_idxs = self._get_aug_input_lens()
 
-        self.length = len(self.X)
+        # samples sorted by augmented length (random order among equal lengths), then cut greedily into batches
+        # of nearby lengths, each holding as many samples as fit into frame_budget padded frames,
+        # without a frame budget batches end where the length changes
+        if shuffle:
+            order = np.random.permutation(self.length)
+        else:
+            order = np.arange(self.length)
 
-    def start_epoch(self, shuffle=True):
-        self.X_aug_lens, self.X_skipped_idxs = self._get_aug_input_lens()
-        len_table = dict()
+        order = order[np.argsort(self.X_aug_lens[order], kind="stable")]
+        sorted_lens = self.X_aug_lens[order]
 
-        for i, length in enumerate(self.X_aug_lens):
-            if length in len_table:
-                len_table[length].append(i)
+        self.batches = []
+        s = 0
+        while s < self.length:
+            e = min(s + self.max_batch_size, self.length)
+            if self.frame_budget is not None:
+                # sorted => padded size of order[s:k] is (k - s) * sorted_lens[k - 1]
+                fits = np.nonzero((np.arange(1, e - s + 1) * sorted_lens[s:e]) <= self.frame_budget)[0]
+                e = s + (fits[-1] + 1 if len(fits) else 1)
             else:
-                len_table[length] = [i]
+                e = s + np.searchsorted(sorted_lens[s:e], sorted_lens[s], side="right")
 
-        self.batches = []
-        lenghts = list(len_table)
+            self.batches.append(order[s:e])
+            s = e
 
         if shuffle:
-            np.random.shuffle(lenghts)
-
-        for l in lenghts:
-            idxs = len_table[l]
-            if shuffle:
-                np.random.shuffle(idxs)
-            s = 0
-            while (s < len(idxs)):
-                e = min(s + self.max_batch_size, len(idxs))
+            self.batches = [self.batches[i] for i in np.random.permutation(len(self.batches))]
 
-                self.batches.append(idxs[s:e])
-
-                s += self.max_batch_size
+        padded_frames = sum(len(batch) * self.X_aug_lens[batch].max() for batch in self.batches)
+        self.padding_efficiency = self.X_aug_lens.sum() / max(padded_frames, 1)
 
         return len(self.batches)
 
-    def get_X_batch(self, idx):
-
+    def _get_frame_idxs(self, i):
+        # frame indices of sample i kept by this epoch's temporal augmentation
+        if self.X_aug_idxs is None:
+            return np.arange(self.X_lens[i])
+
+        return self.X_aug_idxs[self.X_aug_offsets[i]:self.X_aug_offsets[i + 1]]
+
+    def _gather_feats(self, batch_idxs):
+        # whole batch as one fancy-index gather over the packed store, scattered into the zero padded batch,
+        # per-file loads otherwise
+        if self.store is not None and all(self.X[i] in self.store for i in batch_idxs):
+            frame_idxs = [self._get_frame_idxs(i) for i in batch_idxs]
+            rows = np.concatenate([self.store.get_offset(self.X[i]) + idxs for i, idxs in zip(batch_idxs, frame_idxs)])
+            lens = np.array([len(idxs) for idxs in frame_idxs])
+            feats = self.store.data[rows]
+
+            batch_pos = np.repeat(np.arange(len(lens)), lens)
+            frame_pos = np.arange(len(rows)) - np.repeat(np.cumsum(lens) - lens, lens)
+            X_batch = np.zeros((len(batch_idxs), lens.max()) + feats.shape[1:], dtype=feats.dtype)
+            X_batch[batch_pos, frame_pos] = feats
+            return torch.from_numpy(X_batch).float()
+
+        X_batch = []
+        for i in batch_idxs:
+            video = self._load_video(i)
+            if self.augment_temp:
+                video = video[torch.from_numpy(self._get_frame_idxs(i))]
+            X_batch.append(video)
+
+        return pad_batch(X_batch)
+
+    def close(self):
+        # releases the worker processes of the dataset, if any
+        pass
+
+    def get_X_batch(self, idx, rng=np.random):
+        # rng: source of frame augmentation randomness, per-batch generators keep prefetching deterministic
         raise NotImplementedError
 
-    def get_batch(self, idx):
+    def get_batch(self, idx, rng=np.random):
+        # X_lens: true (unpadded) number of frames of every sample of the zero padded X_batch
         batch_idxs = self.batches[idx]
         Y_lens = [len(self.Y[i]) for i in batch_idxs]
 
-        X_batch = self.get_X_batch(idx)
+        X_batch = self.get_X_batch(idx, rng)
+        X_lens = torch.from_numpy(self.X_aug_lens[batch_idxs].astype(np.int64))
 
         max_target_length = max(Y_lens)
 
@@ -188,47 +296,49 @@ class End2EndDataset():
         Y_batch = torch.IntTensor(Y_batch)
         Y_lens = torch.IntTensor(Y_lens)
 
-        return X_batch, Y_batch, Y_lens
+        return X_batch, Y_batch, Y_lens, X_lens
 
     def _get_aug_input_lens(self):
+        # Temporal augmentation plan of the whole epoch, generated at once: random down sampling of every sample,
+        # followed by randomly skipping (at most) one frame per interval of the down sampled video.
+        # Returns augmented lengths, offsets and the flat array of kept frame indices (None without augmentation).
+        X_lens = self.X_lens
         if not self.augment_temp:
-            return self.X_lens, [[]] * self.length
-
-        X_aug_lens = []
-        X_skipped_idxs = []
-        for idx in range(self.length):
-            new_len = self._get_length_down_sample(self.X_lens[idx], len(self.Y[idx]))
-            skipped_idxs = self._get_random_skip_idxs(new_len, len(self.Y[idx]))
-
-            X_skipped_idxs.append(skipped_idxs)
-            X_aug_lens.append(new_len - len(skipped_idxs))
-
-        return X_aug_lens, X_skipped_idxs
-
-    def _get_length_down_sample(self, L, out_seq_len):
-        diff = self._get_aug_diff(L, out_seq_len)
-        if diff < 1:
-            return L
-
-        return int(L - DOWN_SAMPLE_FACTOR * np.random.rand() * diff)
+            return X_lens, None, None
+
+        Y_lens = self.Y_lens
+        n = self.length
+
+        # down sampling to new_len frames: int(linspace(0, L - 1, new_len))
+        diff = self._get_aug_diff(X_lens, Y_lens)
+        new_lens = (X_lens - DOWN_SAMPLE_FACTOR * np.random.rand(n) * diff).astype(np.int64)
+        new_lens = np.where(diff < 1, X_lens, new_lens)
+
+        new_offsets = np.concatenate([[0], np.cumsum(new_lens)])
+        frame_sample = np.repeat(np.arange(n), new_lens)
+        frame_pos = np.arange(new_offsets[-1]) - new_offsets[frame_sample]
+        step = (X_lens - 1) / np.maximum(new_lens - 1, 1)
+        frame_idxs = (frame_pos * step[frame_sample]).astype(np.int64)
+        last = new_offsets[1:][new_lens > 1] - 1
+        frame_idxs[last] = (X_lens - 1)[new_lens > 1]
+
+        # random skip: diff intervals of linspace(0, new_len - 1, diff + 1), each loses a frame with RANDOM_SKIP_TH
+        diff = self._get_aug_diff(new_lens, Y_lens)
+        n_intervals = np.where(diff < 3, 0, diff)
+        interval_sample = np.repeat(np.arange(n), n_intervals)
+        interval_pos = np.arange(n_intervals.sum()) - np.repeat(np.cumsum(n_intervals) - n_intervals, n_intervals)
+        interval_len = ((new_lens - 1) / np.maximum(n_intervals, 1))[interval_sample]
+        skip_pos = (np.random.rand(len(interval_sample)) * interval_len + interval_pos * interval_len).astype(np.int64)
+        skipped = np.random.rand(len(interval_sample)) < RANDOM_SKIP_TH
+
+        keep = np.ones(len(frame_idxs), dtype=bool)
+        keep[new_offsets[interval_sample[skipped]] + skip_pos[skipped]] = False
+
+        X_aug_idxs = frame_idxs[keep]
+        X_aug_lens = np.bincount(frame_sample[keep], minlength=n)
+        X_aug_offsets = np.concatenate([[0], np.cumsum(X_aug_lens)])
+
+        return X_aug_lens, X_aug_offsets, X_aug_idxs
 
     def _get_aug_diff(self, L, out_seq_len):
         return L - out_seq_len * 4
-
-    def _get_random_skip_idxs(self, L, out_seq_len):
-        diff = self._get_aug_diff(L, out_seq_len)
-        if diff < 3:
-            return []
-
-        skipped_idxs = []
-        idxs = np.linspace(0, L - 1, diff + 1)
-
-        for i in range(1, len(idxs)):
-            if np.random.rand() < RANDOM_SKIP_TH:
-                step = idxs[i] - idxs[i - 1]
-                skip_idx = int(np.random.rand() * step + idxs[i - 1])
-                if not skipped_idxs or skip_idx != skipped_idxs[-1]:
-                    skipped_idxs.append(skip_idx)
-
-        skipped_idxs.sort()
-        return skipped_idxs
@@ -3,83 +3,98 @@ import numpy as np
 import sys
 
 sys.path.append("..")
-from dataset.end2end_base import End2EndDataset, random_skip, down_sample
+from dataset.end2end_base import End2EndDataset, pad_batch
 
 from config import *
-from utils import get_video_path
+from utils import get_video_path, get_packed_feats_path, get_feat_shape
+from processing_tools import get_pose_selection, select_pose_keypoints
 from vocab import Vocab
 
 
-def process_video_pose(video_pose, augment_frame=True):
-    video_pose = video_pose.reshape(-1, 137, 3)
-    idxs = []
-    video_pose = video_pose[:, :, :2]
+_pose_selection = None
 
-    noise = []
-    if POSE_FACE:
-        idxs += list(range(70))
-        noise.append(POSE_AUG_NOISE_HANDFACE - 2 * POSE_AUG_NOISE_HANDFACE * np.random.rand(len(video_pose), 70, 2))
 
-    if POSE_BODY:
-        idxs += list(range(70, 70 + 8)) + list(range(70 + 15, 70 + 19))
-        noise.append(POSE_AUG_NOISE_BODY - 2 * POSE_AUG_NOISE_BODY * np.random.rand(len(video_pose), 12, 2))
+def get_pose_arrays():
+    # (keypoint indices, noise amplitudes) of the pose selection, computed on first use (pose models only)
+    global _pose_selection
+    if _pose_selection is None:
+        _pose_selection = get_pose_selection()
 
-    if POSE_HANDS:
-        idxs += list(range(95, 137))
-        noise.append(POSE_AUG_NOISE_HANDFACE - 2 * POSE_AUG_NOISE_HANDFACE * np.random.rand(len(video_pose), 42, 2))
+    return _pose_selection
 
-    video_pose = video_pose[:, idxs]
+
+def get_pose_noise(shape, rng=np.random):
+    # keypoint noise for (..., T, K, 2) poses plus one random offset per sequence
+    noise = get_pose_arrays()[1][:, None] * (1 - 2 * rng.rand(*shape))
+    offset = POSE_AUG_OFFSET * (1 - 2 * rng.rand(*shape[:-3], 1, 1, 2))
+    return (noise + offset).astype(np.float32)
+
+
+def process_video_pose(video_pose, augment_frame=True, rng=np.random):
+    video_pose = select_pose_keypoints(video_pose, get_pose_arrays()[0])
 
     if augment_frame:
-        noise = np.concatenate(noise, axis=1)
-        offset = POSE_AUG_OFFSET - 2 * POSE_AUG_OFFSET * np.random.rand(2)
-        video_pose += noise + offset
+        video_pose += get_pose_noise(video_pose.shape, rng)
 
     return video_pose.reshape(len(video_pose), -1)
 
 
 class End2EndImgFeatDataset(End2EndDataset):
-    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True):
-        super(End2EndImgFeatDataset, self).__init__(vocab, split, max_batch_size, augment_frame, augment_temp, load)
+    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True,
+                 frame_budget=None):
+        super(End2EndImgFeatDataset, self).__init__(vocab, split, max_batch_size, augment_frame, augment_temp, load,
+                                                    frame_budget)
 
     def _get_ffm(self):
         return os.path.join("IMG_FEAT", STF_MODEL + "_" + str(IMG_FEAT_SIZE))
 
-    def _get_feat(self, row, glosses=None):
+    def _get_store_path(self):
+        return get_packed_feats_path(self.split, stf_feat=False) if FEAT_PACKED else None
+
+    def _open_store(self):
+        super(End2EndImgFeatDataset, self)._open_store()
+        if (STF_MODEL.startswith("pose") and self.store is not None
+                and self.store.shape[1:] != (len(get_pose_arrays()[0]) * 2,)):
+            # packed with another POSE_BODY/POSE_HANDS/POSE_FACE selection
+            print("Packed pose store doesn't match the keypoint selection, ignored")
+            self.store = None
+
+    def _load_pose(self, i):
+        # (T, K, 2) selected keypoints, from the packed store when available
+        if self.store is not None and self.X[i] in self.store:
+            return self.store.get(self.X[i]).reshape(-1, len(get_pose_arrays()[0]), 2).astype(np.float32)
+
+        return select_pose_keypoints(np.load(self.X[i]), get_pose_arrays()[0])
+
+    def _get_feat_path(self, row):
         ext = ".npy" if STF_MODEL.startswith("pose") else ".pt"
         video_path, feat_path = get_video_path(row, self.split, feat_ext=ext, stf_feat=False)
+        return feat_path
 
-        if not os.path.exists(feat_path):
-            return None, None, None
-
-        feat = np.load(feat_path) if STF_MODEL.startswith("pose") else torch.load(feat_path)
-        feat_len = len(feat)
+    def _get_feat_len(self, feat_path):
+        if self.store is not None and feat_path in self.store:
+            return self.store.get_length(feat_path)
 
-        if feat_len < len(glosses) or len(feat.shape) < 2:
-            return None, None, None
+        feat_shape = get_feat_shape(feat_path)
+        if len(feat_shape) < 2:
+            return None
 
-        return feat_path, feat, feat_len
+        return feat_shape[0]
 
-    def get_X_batch(self, idx):
+    def get_X_batch(self, idx, rng=np.random):
         batch_idxs = self.batches[idx]
-        X_batch = []
-        for i in batch_idxs:
-            if STF_MODEL.startswith("pose"):
-                video = np.load(self.X[i])
-                video = process_video_pose(video, augment_frame=self.augment_frame)
-            else:
-                video = torch.load(self.X[i])
-            if self.augment_temp:
-                video = down_sample(video, self.X_aug_lens[i] + len(self.X_skipped_idxs[i]))
-                video = random_skip(video, self.X_skipped_idxs[i])
-                video = np.stack(video) if STF_MODEL.startswith("pose") else torch.stack(video)
-
-            X_batch.append(video)
-
-        if STF_MODEL.startswith("pose"):
-            X_batch = torch.from_numpy(np.stack(X_batch).astype(np.float32)).unsqueeze(1)
-        else:
-            X_batch = torch.stack(X_batch)
+        if not STF_MODEL.startswith("pose"):
+            return self._gather_feats(batch_idxs)
+
+        # whole batch augmented at once, (B, T, K, 2) noise masked to the real frames
+        X_batch = pad_batch([self._load_pose(i)[self._get_frame_idxs(i)] for i in batch_idxs])
+        B, T = X_batch.shape[:2]
+        if self.augment_frame:
+            mask = np.arange(T)[None] < self.X_aug_lens[batch_idxs][:, None]
+            noise = get_pose_noise(X_batch.shape, rng) * mask[:, :, None, None]
+            X_batch += torch.from_numpy(noise)
+
+        X_batch = X_batch.view(B, T, -1).unsqueeze(1)
 
         return X_batch
 
@@ -93,8 +108,9 @@ if __name__ == "__main__":
 
     dataset.start_epoch()
 
-    X_batch, Y_batch, Y_lens = dataset.get_batch(0)
+    X_batch, Y_batch, Y_lens, X_lens = dataset.get_batch(0)
 
     print(X_batch.size())
     print(Y_batch.size())
     print(Y_lens.size())
+    print(X_lens)
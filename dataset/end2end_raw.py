@@ -1,77 +1,170 @@
 import sys
+import threading
+from multiprocessing import Pool, shared_memory
 
 sys.path.append("..")
 from dataset.end2end_base import *
 
-from processing_tools import get_images, preprocess_2d, preprocess_3d
+from processing_tools import get_images, get_video_len, preprocess_2d, preprocess_3d, preprocess_clip
 from vocab import Vocab
 
-from utils import get_video_path
+from utils import get_video_path, get_frame_store_path
+from packed_store import open_packed_store
 
 
-def get_video_worker(args):
-    images, aug_frame, aug_temp, aug_len, skip_idxs = args
+def get_video_shape(T):
+    if STF_TYPE == 0:
+        return T, 3, IMG_SIZE_2D, IMG_SIZE_2D
+    else:
+        return 3, T, IMG_SIZE_2Plus1D, IMG_SIZE_2Plus1D
 
-    if aug_temp:
-        images = down_sample(images, aug_len + len(skip_idxs))
-        images = random_skip(images, skip_idxs)
 
-    if aug_frame:
-        crop_video(images)
+def get_clip_out(X_batch, slot, T):
+    # first T frames of the slot's (zero padded) video, in the batch layout
+    if STF_TYPE == 0:
+        return X_batch[slot, :T]
+    else:
+        return X_batch[slot, :, :T]
+
+
+def load_images(video_path, store_path=None, frame_idxs=None):
+    # Frames from the frame store when the video is in it, decoding the video otherwise.
+    # frame_idxs: frames kept by the temporal augmentation, only those are read/decoded
+    if store_path is not None:
+        store = open_packed_store(store_path)
+        if video_path in store:
+            images = store.get(video_path)
+            if frame_idxs is not None:
+                images = images[np.minimum(frame_idxs, len(images) - 1)]
+            return images
+
+    if frame_idxs is None:
+        return get_images(video_path)
+
+    images = get_images(video_path, frame_idxs=frame_idxs)
+    if len(images) != len(frame_idxs):
+        # video is shorter than its manifest length, clamp the plan to the frames it really has
+        images = get_images(video_path)
+        images = [images[i] for i in np.minimum(frame_idxs, len(images) - 1)]
+
+    return images
 
-    video = []
-    for img in images:
-        if STF_TYPE == 0:
-            img = preprocess_2d(img)
-        else:
-            img = preprocess_3d(img)
-        video.append(img)
 
-    video = np.stack(video).astype(np.float32)
+def get_video_worker(args, out=None):
+    images, aug_frame, rng = args
 
+    if aug_frame:
+        crop_video(images, rng)
+
+    # written straight into the final layout, (T, C, H, W) for 2D and (C, T, H, W) for 3D
     if STF_TYPE == 0:
-        video = video.transpose([0, 3, 1, 2])
+        return preprocess_clip(images, preprocess_2d, channels_first=False, out=out)
     else:
-        video = video.transpose([3, 0, 1, 2])
+        return preprocess_clip(images, preprocess_3d, channels_first=True, out=out)
+
 
-    return video
+def get_video_shm_worker(args):
+    # decodes, augments and preprocesses one clip into its slot of the shared batch buffer,
+    # so only the (small) arguments travel between processes
+    shm_name, batch_shape, slot, T, video_path, store_path, frame_idxs, aug_frame, seed = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        X_batch = np.ndarray(batch_shape, dtype=np.float32, buffer=shm.buf)
+        images = load_images(video_path, store_path, frame_idxs)
+        get_video_worker((images, aug_frame, np.random.RandomState(seed)), out=get_clip_out(X_batch, slot, T))
+        del X_batch
+    finally:
+        shm.close()
 
 
 class End2EndRawDataset(End2EndDataset):
-    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True):
-        super(End2EndRawDataset, self).__init__(vocab, split, max_batch_size, augment_frame, augment_temp, load)
+    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True,
+                 frame_budget=None):
+        self.pool = None
+        # BatchPrefetcher threads ask for the pool concurrently, only one may create it
+        self.pool_lock = threading.Lock()
+        super(End2EndRawDataset, self).__init__(vocab, split, max_batch_size, augment_frame, augment_temp, load,
+                                                frame_budget)
 
     def _get_ffm(self):
         return "videos"
 
+    def _get_store_path(self):
+        return get_frame_store_path(self.split) if USE_FRAME_STORE else None
+
     def _show_progress(self):
         return SHOW_PROGRESS
 
-    def _get_feat(self, row, glosses=None):
-
+    def _get_feat_path(self, row):
         video_path, feat_path = get_video_path(row, self.split)
+        return video_path
 
-        feat = get_images(video_path)
-        feat_len = len(feat)
+    def _get_feat_len(self, video_path):
+        if self.store is not None and video_path in self.store:
+            return self.store.get_length(video_path)
 
-        if feat_len < len(glosses) * 4:
-            return None, None, None
+        return get_video_len(video_path)
 
-        return video_path, feat, feat_len
+    def _get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                n_workers = END2END_RAW_WORKERS if END2END_RAW_WORKERS is not None else os.cpu_count()
+                self.pool = Pool(n_workers)
 
-    def get_X_batch(self, idx):
-        batch_idxs = self.batches[idx]
-        arg_list = []
-        for i in batch_idxs:
-            images = get_images(self.X[i])
-            arg_list.append((images, self.augment_frame, self.augment_temp,
-                             self.X_aug_lens[i], self.X_skipped_idxs[i]))
+            return self.pool
+
+    def close(self):
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["pool"] = None
+        del state["pool_lock"]
+        return state
 
-        X_batch = []
-        for arg in arg_list:
-            X_batch.append(get_video_worker(arg))
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool_lock = threading.Lock()
 
-        X_batch = torch.from_numpy(np.stack(X_batch))
+    def _get_aug_frame_idxs(self, i):
+        return self._get_frame_idxs(i) if self.augment_temp else None
+
+    def get_X_batch(self, idx, rng=np.random):
+        batch_idxs = self.batches[idx]
+        # one seed per clip, so the result is the same for the serial and the multi-process path
+        seeds = rng.randint(2 ** 31, size=len(batch_idxs))
+        lens = self.X_aug_lens[batch_idxs]
+        batch_shape = (len(batch_idxs),) + get_video_shape(lens.max())
+        store_path = self.store.store_path if self.store is not None else None
+
+        if END2END_RAW_WORKERS is not None and END2END_RAW_WORKERS <= 1:
+            X_batch = np.zeros(batch_shape, dtype=np.float32)
+            for slot, i in enumerate(batch_idxs):
+                images = load_images(self.X[i], store_path, self._get_aug_frame_idxs(i))
+                get_video_worker((images, self.augment_frame, np.random.RandomState(seeds[slot])),
+                                 out=get_clip_out(X_batch, slot, lens[slot]))
+
+            return torch.from_numpy(X_batch)
+
+        # new shared memory is zero filled, so the padding needs no writes
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(batch_shape)) * 4)
+        try:
+            arg_list = []
+            for slot, i in enumerate(batch_idxs):
+                arg_list.append((shm.name, batch_shape, slot, lens[slot], self.X[i], store_path,
+                                 self._get_aug_frame_idxs(i), self.augment_frame, seeds[slot]))
+
+            self._get_pool().map(get_video_shm_worker, arg_list)
+
+            X_batch = np.ndarray(batch_shape, dtype=np.float32, buffer=shm.buf)
+            X_batch = torch.from_numpy(X_batch.copy())
+        finally:
+            shm.close()
+            shm.unlink()
 
         return X_batch
 
@@ -82,8 +175,9 @@ if __name__ == "__main__":
 
     dataset.start_epoch()
 
-    X_batch, Y_batch, Y_lens = dataset.get_batch(0)
+    X_batch, Y_batch, Y_lens, X_lens = dataset.get_batch(0)
 
     print(X_batch.size())
     print(Y_batch.size())
     print(Y_lens.size())
+    print(X_lens)
@@ -1,49 +1,40 @@
-import torch
+import numpy as np
 
-from dataset.end2end_base import End2EndDataset, random_skip, down_sample
+from dataset.end2end_base import End2EndDataset
 
 from config import *
-from utils import get_video_path
+from utils import get_video_path, get_packed_feats_path, get_feat_shape
 from vocab import Vocab
 
 
 class End2EndSTFDataset(End2EndDataset):
-    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True):
-        super(End2EndSTFDataset, self).__init__(vocab, split, max_batch_size, augment_frame, augment_temp, load)
+    def __init__(self, vocab, split, max_batch_size, augment_frame=True, augment_temp=True, load=True,
+                 frame_budget=None):
+        super(End2EndSTFDataset, self).__init__(vocab, split, max_batch_size, augment_frame, augment_temp, load,
+                                                frame_budget)
 
     def _get_ffm(self):
         return os.path.join("ST_FEAT", STF_MODEL + "_" + str(IMG_FEAT_SIZE))
 
-    def _get_feat(self, row, glosses=None):
-        video_path, feat_path = get_video_path(row, self.split)
-
-        if not os.path.exists(feat_path):
-            return None, None, None
-
-        feat = torch.load(feat_path)
-        feat_len = len(feat)
+    def _get_store_path(self):
+        return get_packed_feats_path(self.split) if FEAT_PACKED else None
 
-        if feat_len < len(glosses) or len(feat.shape) < 2:
-            return None, None, None
-
-        return feat_path, feat, feat_len
-
-    def get_X_batch(self, idx):
-        batch_idxs = self.batches[idx]
-        X_batch = []
-        for i in batch_idxs:
+    def _get_feat_path(self, row):
+        video_path, feat_path = get_video_path(row, self.split)
+        return feat_path
 
-            video = torch.load(self.X[i])
-            if self.augment_temp:
-                video = down_sample(video, self.X_aug_lens[i] + len(self.X_skipped_idxs[i]))
-                video = random_skip(video, self.X_skipped_idxs[i])
-                video = torch.stack(video)
+    def _get_feat_len(self, feat_path):
+        if self.store is not None and feat_path in self.store:
+            return self.store.get_length(feat_path)
 
-            X_batch.append(video)
+        feat_shape = get_feat_shape(feat_path)
+        if len(feat_shape) < 2:
+            return None
 
-        X_batch = torch.stack(X_batch)
+        return feat_shape[0]
 
-        return X_batch
+    def get_X_batch(self, idx, rng=np.random):
+        return self._gather_feats(self.batches[idx])
 
     def _get_aug_diff(self, L, out_seq_len):
         return L - out_seq_len
@@ -55,8 +46,9 @@ if __name__ == "__main__":
 
     dataset.start_epoch()
 
-    X_batch, Y_batch, Y_lens = dataset.get_batch(0)
+    X_batch, Y_batch, Y_lens, X_lens = dataset.get_batch(0)
 
     print(X_batch.size())
     print(Y_batch.size())
     print(Y_lens.size())
+    print(X_lens)
@@ -2,13 +2,13 @@ from config import *
 import numpy as np
 import pickle
 import glob
-import cv2
 import torch
 import PIL
 import pandas as pd
 
-from utils import ProgressPrinter
-from processing_tools import preprocess_3d, preprocess_2d
+from utils import ProgressPrinter, get_frame_store_path
+from processing_tools import preprocess_3d, preprocess_2d, preprocess_clip, get_images
+from packed_store import open_packed_store, packed_store_exists
 from vocab import Vocab
 
 
@@ -23,8 +23,23 @@ class GR_dataset():
 
         self.stf_type = stf_type
         self.load_dataset(split)
+        self.store = self.open_frame_store()
 
+    def open_frame_store(self):
+        if not USE_FRAME_STORE:
+            return None
 
+        store_path = get_frame_store_path("GR", self.stf_type)
+        data_path = os.sep.join([GR_DATASET_DIR, "VARS", "data.pkl"])
+        if not packed_store_exists(store_path):
+            return None
+
+        # GR videos are rewritten by every generate_gloss_dataset run
+        if os.path.getmtime(store_path + ".bin") < os.path.getmtime(data_path):
+            print("GR frame store is older than the GR dataset, decoding videos")
+            return None
+
+        return open_packed_store(store_path)
 
     def load_dataset(self, split):
         data_path = os.sep.join([GR_DATASET_DIR, "VARS", "data.pkl"])
@@ -53,26 +68,23 @@ class GR_dataset():
     def get_sample(self, i):
         y = self.Y[i]
         gloss_video_path = self.X[i]
-        images = []
-        cap = cv2.VideoCapture(gloss_video_path)
-
-        while True:
-            ret, img = cap.read()
-            if not ret:
-                break
+        if self.store is not None and gloss_video_path in self.store:
+            frames = self.store.get(gloss_video_path)
+        else:
+            frames = get_images(gloss_video_path)
 
+        images = []
+        for img in frames:
             h, w = img.shape[:2]
             y1, x1 = int(0.2 * np.random.rand() * h), int(0.2 * np.random.rand() * h)
             y2, x2 = h - int(0.2 * np.random.rand() * h), w - int(0.2 * np.random.rand() * h)
-            img = img[y1:y2, x1:x2]
-            if self.stf_type == 1:
-                img = preprocess_3d(img)
-            else:
-                img = preprocess_2d(img)
-            images.append(img)
+            images.append(img[y1:y2, x1:x2])
 
-        cap.release()
-        x = np.stack(images)
+        # (C, T, H, W) for 3D, (T, C, H, W) for 2D
+        if self.stf_type == 1:
+            x = preprocess_clip(images, preprocess_3d, channels_first=True)
+        else:
+            x = preprocess_clip(images, preprocess_2d, channels_first=False)
 
         return x, y
 
@@ -117,13 +129,7 @@ class GR_dataset():
             X_batch.append(x)
             Y_batch.append(y)
 
-        X_batch = np.stack(X_batch)
-        if self.stf_type == 0:
-            X_batch = X_batch.transpose([0, 1, 4, 2, 3])
-        else:
-            X_batch = X_batch.transpose([0, 4, 1, 2, 3])
-
-        X_batch = torch.Tensor(X_batch)
+        X_batch = torch.from_numpy(np.stack(X_batch))
         Y_batch = torch.LongTensor(Y_batch)
 
         return X_batch, Y_batch
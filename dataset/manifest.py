@@ -0,0 +1,70 @@
+import os
+import numpy as np
+from utils import atomic_save
+
+# End2End dataset manifest of a split, two .npy files opened memory-mapped:
+#   manifest_<split>.npy  one record per sample: feature/video path, its size and mtime when it was read,
+#                         its length and where its glosses are in the flat gloss array
+#   Y_<split>.npy         glosses of all samples, concatenated
+# The size/mtime pairs let a rebuild re-read only new or changed files.
+
+
+def get_manifest_paths(dataset_dir, split):
+    return os.path.join(dataset_dir, "manifest_" + split + ".npy"), os.path.join(dataset_dir, "Y_" + split + ".npy")
+
+
+def manifest_exists(dataset_dir, split):
+    rows_path, Y_path = get_manifest_paths(dataset_dir, split)
+    return os.path.exists(rows_path) and os.path.exists(Y_path)
+
+
+def load_manifest(dataset_dir, split):
+    rows_path, Y_path = get_manifest_paths(dataset_dir, split)
+    return np.load(rows_path, mmap_mode="r"), np.load(Y_path, mmap_mode="r")
+
+
+def save_manifest(dataset_dir, split, paths, sizes, mtimes, lens, Y):
+    if not os.path.exists(dataset_dir):
+        os.makedirs(dataset_dir)
+
+    path_len = max([len(path) for path in paths] + [1])
+    rows = np.zeros(len(paths), dtype=[("path", "U" + str(path_len)), ("size", np.int64), ("mtime", np.float64),
+                                       ("len", np.int64), ("y_offset", np.int64), ("y_len", np.int64)])
+    rows["path"] = paths
+    rows["size"] = sizes
+    rows["mtime"] = mtimes
+    rows["len"] = lens
+    rows["y_len"] = [len(y) for y in Y]
+    rows["y_offset"] = np.cumsum(rows["y_len"]) - rows["y_len"]
+    Y_flat = np.concatenate([np.array(y, dtype=np.int32) for y in Y] + [np.zeros(0, dtype=np.int32)])
+
+    rows_path, Y_path = get_manifest_paths(dataset_dir, split)
+    atomic_save(Y_path, lambda f: np.save(f, Y_flat))
+    atomic_save(rows_path, lambda f: np.save(f, rows))
+
+
+def get_file_stat(path):
+    if path.endswith("*.png"):
+        # png frame folder, its mtime changes when frames are added or removed
+        path = os.path.dirname(path)
+
+    if not os.path.exists(path):
+        return None
+
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime
+
+
+class RaggedArray():
+    # list-like view of variable length rows stored in one flat array
+    def __init__(self, flat, offsets, lengths):
+        self.flat = flat
+        self.offsets = offsets
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        s = self.offsets[i]
+        return self.flat[s:s + self.lengths[i]]
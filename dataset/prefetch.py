@@ -0,0 +1,79 @@
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import sys
+
+sys.path.append("..")
+from config import *
+
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _get_batch_worker(idx, seed):
+    return _worker_dataset.get_batch(idx, get_batch_rng(seed, idx))
+
+
+def get_batch_rng(seed, idx):
+    # every batch gets its own stream, so results don't depend on worker count or scheduling
+    return np.random.RandomState([seed, idx])
+
+
+class BatchPrefetcher():
+    # Assembles the next batches of a started End2EndDataset epoch in background workers
+    # while the current one is in use. Yields (X_batch, Y_batch, Y_lens, X_lens) in batch order.
+    def __init__(self, dataset, n_batches, depth=END2END_PREFETCH_DEPTH, n_workers=END2END_PREFETCH_WORKERS,
+                 processes=END2END_PREFETCH_PROCESSES):
+        self.dataset = dataset
+        self.n_batches = n_batches
+        self.depth = max(depth, 1)
+        self.n_workers = n_workers
+        self.processes = processes
+        # drawn from the global generator, so np.random.seed still makes the whole run reproducible
+        self.seed = np.random.randint(2 ** 31)
+
+    def __len__(self):
+        return self.n_batches
+
+    def _get_executor(self):
+        if self.processes:
+            # workers fork after start_epoch, so they see this epoch's batches and augmentation plan
+            return ProcessPoolExecutor(self.n_workers, initializer=_init_worker, initargs=(self.dataset,))
+
+        return ThreadPoolExecutor(self.n_workers)
+
+    def _submit(self, executor, idx):
+        if self.processes:
+            return executor.submit(_get_batch_worker, idx, self.seed)
+
+        return executor.submit(self.dataset.get_batch, idx, get_batch_rng(self.seed, idx))
+
+    def __iter__(self):
+        if self.n_workers < 1:
+            for idx in range(self.n_batches):
+                yield self.dataset.get_batch(idx, get_batch_rng(self.seed, idx))
+            return
+
+        executor = self._get_executor()
+        futures = deque()
+        next_idx = 0
+        try:
+            while next_idx < self.n_batches and len(futures) < self.depth:
+                futures.append(self._submit(executor, next_idx))
+                next_idx += 1
+
+            while futures:
+                batch = futures.popleft().result()
+                if next_idx < self.n_batches:
+                    futures.append(self._submit(executor, next_idx))
+                    next_idx += 1
+
+                yield batch
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,210 @@
+import math
+import heapq
+import numpy as np
+import torch
+from multiprocessing import Pool
+from collections import defaultdict
+from config import *
+from utils import get_split_df
+
+NEG_INF = float("-inf")
+
+
+def log_add(a, b):
+    if a == NEG_INF:
+        return b
+    if b == NEG_INF:
+        return a
+    if a > b:
+        return a + math.log1p(math.exp(b - a))
+    return b + math.log1p(math.exp(a - b))
+
+
+class GlossLM():
+    # n-gram language model over gloss indices with interpolated Witten-Bell smoothing,
+    # -1 => sentence start, -2 => sentence end
+    def __init__(self, sentences, vocab_size, order=LM_ORDER):
+        self.order = order
+        self.vocab_size = vocab_size
+        # counts[context][gloss] for contexts of 0 ... order - 1 glosses
+        self.counts = defaultdict(lambda: defaultdict(int))
+        for sentence in sentences:
+            sentence = [-1] * (order - 1) + list(sentence) + [-2]
+            for i in range(order - 1, len(sentence)):
+                for n in range(order):
+                    self.counts[tuple(sentence[i - n:i])][sentence[i]] += 1
+
+        self.totals = {context: sum(counts.values()) for context, counts in self.counts.items()}
+        self.counts = {context: dict(counts) for context, counts in self.counts.items()}
+        self.cache = {}
+
+    def prob(self, context, gloss):
+        if not context:
+            # backs off to uniform over the glosses and the sentence end
+            p_lower = 1 / self.vocab_size
+        else:
+            p_lower = self.prob(context[1:], gloss)
+
+        if context not in self.counts:
+            return p_lower
+
+        counts = self.counts[context]
+        n_types = len(counts)
+        return (counts.get(gloss, 0) + n_types * p_lower) / (self.totals[context] + n_types)
+
+    def log_prob(self, context, gloss):
+        # context: tuple of the glosses before (sentence start is padded here)
+        context = context[-(self.order - 1):] if self.order > 1 else ()
+        key = (context, gloss)
+        if key not in self.cache:
+            padded = (-1,) * (self.order - 1 - len(context)) + context
+            self.cache[key] = math.log(self.prob(padded, gloss))
+
+        return self.cache[key]
+
+
+def get_gloss_lm(vocab, order=LM_ORDER):
+    sentences = [vocab.encode(annotation) for annotation in get_split_df("train").annotation]
+    return GlossLM(sentences, vocab.size, order)
+
+
+def prefix_beam_search(log_probs, beam_width, prune_th, top_n, lm=None, alpha=0., beta=0., blank=0):
+    # CTC prefix beam search over a (T, V) log probability matrix,
+    # every beam keeps the log probabilities of its prefix ending in blank and in non blank.
+    # At each step only the (at most top_n) labels with probability >= prune_th (or else the best) extend the beams.
+    # Returns up to beam_width (prefix, timesteps, score) sorted by score (log probability + LM and length terms)
+    log_prune_th = math.log(prune_th) if prune_th > 0 else NEG_INF
+    # prefix => [p_blank, p_non_blank, lm + length score, timesteps]
+    beams = {(): [0., NEG_INF, 0., ()]}
+
+    for t in range(log_probs.shape[0]):
+        step = log_probs[t]
+        if top_n < len(step):
+            labels = np.argpartition(step, -top_n)[-top_n:]
+            labels = labels[step[labels] >= log_prune_th].tolist()
+        else:
+            labels = np.nonzero(step >= log_prune_th)[0].tolist()
+
+        if not labels:
+            labels = [int(step.argmax())]
+
+        p_labels = [(label, float(step[label])) for label in labels if label != blank]
+        p_blank = float(step[blank])
+        next_beams = {}
+
+        for prefix, (p_b, p_nb, extra, timesteps) in beams.items():
+            p_total = log_add(p_b, p_nb)
+            beam = next_beams.get(prefix)
+            if beam is None:
+                beam = next_beams[prefix] = [NEG_INF, NEG_INF, extra, timesteps]
+            beam[0] = log_add(beam[0], p_total + p_blank)
+
+            last = prefix[-1] if prefix else None
+            for label, p in p_labels:
+                if label == last:
+                    # repeated label only extends the prefix after a blank
+                    beam[1] = log_add(beam[1], p_nb + p)
+                    p_extend = p_b + p
+                else:
+                    p_extend = p_total + p
+
+                if p_extend == NEG_INF:
+                    continue
+
+                new_prefix = prefix + (label,)
+                new_beam = next_beams.get(new_prefix)
+                if new_beam is None:
+                    if new_prefix in beams:
+                        # already a beam, keeps the steps its labels started at
+                        new_extra, new_timesteps = beams[new_prefix][2:]
+                    else:
+                        new_extra = extra + beta
+                        if lm is not None:
+                            new_extra += alpha * lm.log_prob(prefix, label)
+                        new_timesteps = timesteps + (t,)
+                    new_beam = next_beams[new_prefix] = [NEG_INF, NEG_INF, new_extra, new_timesteps]
+
+                new_beam[1] = log_add(new_beam[1], p_extend)
+
+        # pruning by beam width
+        if len(next_beams) > beam_width:
+            next_beams = dict(heapq.nlargest(beam_width, next_beams.items(),
+                                             key=lambda item: log_add(item[1][0], item[1][1]) + item[1][2]))
+        beams = next_beams
+
+    results = []
+    for prefix, (p_b, p_nb, extra, timesteps) in beams.items():
+        score = log_add(p_b, p_nb) + extra
+        if lm is not None:
+            score += alpha * lm.log_prob(prefix, -2)
+        results.append((prefix, timesteps, score))
+
+    return sorted(results, key=lambda result: result[2], reverse=True)
+
+
+_worker_args = None
+
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args
+
+
+def _decode_worker(log_probs):
+    return prefix_beam_search(log_probs, *_worker_args)
+
+
+class CTCBeamDecoder():
+    # drop-in for ctcdecode's CTCBeamDecoder: decode(probs (N, T, V), seq_lens) =>
+    # beam_result (N, beam_width, T), beam_scores (N, beam_width), timesteps (N, beam_width, T), out_seq_len
+    # beam_scores are negative log likelihoods (lower is better), missing beams have length 0 and score inf
+    def __init__(self, beam_width=BEAM_WIDTH, prune_th=BEAM_PRUNE_TH, top_n=BEAM_TOP_N, lm=None, alpha=LM_ALPHA,
+                 beta=LM_BETA, n_workers=DECODER_WORKERS, blank=0):
+        self.beam_width = beam_width
+        self.args = (beam_width, prune_th, top_n, lm, alpha, beta, blank)
+        self.n_workers = n_workers
+        self.pool = None
+
+    def decode(self, probs, seq_lens=None):
+        N, T = probs.shape[:2]
+        if seq_lens is None:
+            seq_lens = [T] * N
+
+        log_probs = torch.log(probs.float().clamp(min=1e-30)).cpu().numpy()
+        log_probs = [log_probs[i, :int(seq_lens[i])] for i in range(N)]
+
+        if self.n_workers == 1 or N == 1:
+            results = [prefix_beam_search(lp, *self.args) for lp in log_probs]
+        else:
+            if self.pool is None:
+                # the LM is sent to every worker once
+                self.pool = Pool(self.n_workers, initializer=_init_worker, initargs=(self.args,))
+            results = self.pool.map(_decode_worker, log_probs, chunksize=4)
+
+        beam_result = torch.zeros((N, self.beam_width, T), dtype=torch.int)
+        timesteps = torch.zeros((N, self.beam_width, T), dtype=torch.int)
+        beam_scores = torch.full((N, self.beam_width), float("inf"))
+        out_seq_len = torch.zeros((N, self.beam_width), dtype=torch.int)
+
+        for i, beams in enumerate(results):
+            for j, (prefix, steps, score) in enumerate(beams):
+                beam_result[i, j, :len(prefix)] = torch.IntTensor(prefix)
+                timesteps[i, j, :len(steps)] = torch.IntTensor(steps)
+                beam_scores[i, j] = -score
+                out_seq_len[i, j] = len(prefix)
+
+        return beam_result, beam_scores, timesteps, out_seq_len
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+def get_decoder(vocab, decoder=END2END_DECODER):
+    # None => greedy decoding in predict_glosses
+    if decoder != "beam":
+        return None
+
+    lm = get_gloss_lm(vocab) if LM_ORDER > 0 else None
+    return CTCBeamDecoder(lm=lm)
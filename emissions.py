@@ -0,0 +1,81 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from config import *
+from packed_store import PackedStore, packed_store_exists, write_packed_store
+from dataset.manifest import get_file_stat
+
+
+# Per utterance log probabilities (log_softmax of the End2End model output) cached in a float16 packed store.
+# A store belongs to one set of weights (hash of the model state) and one split, its entries to one version of the
+# input file (path + size + mtime), so decoding, alignment and scoring can be rerun without the model forward.
+
+def get_model_hash(model):
+    h = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def get_emission_key(path, packed_path=None):
+    # path of the features (or video) the emissions come from, packed_path: the packed store holding them
+    stat = get_file_stat(path)
+    if stat is None and packed_path is not None:
+        # only packed, the packed file versions them
+        stat = get_file_stat(packed_path + ".bin")
+
+    if stat is None:
+        return path
+
+    return "%s|%d|%d" % (path, stat[0], int(stat[1]))
+
+
+def pad_emissions(emissions):
+    # list of (T, V) => zero padded (T_max, N, V) like the model output, lengths
+    lens = torch.LongTensor([len(emission) for emission in emissions])
+    return torch.nn.utils.rnn.pad_sequence(emissions), lens
+
+
+class EmissionCache():
+    # emissions of one model on one split, new ones are added with put and written with save
+    def __init__(self, model_hash, split):
+        self.store_path = os.sep.join([EMISSION_CACHE_DIR, model_hash, split])
+        self.store = PackedStore(self.store_path) if packed_store_exists(self.store_path) else None
+        self.new = {}
+
+    def __contains__(self, key):
+        return key in self.new or (self.store is not None and key in self.store)
+
+    def get(self, key):
+        # (T, V) float32 log probabilities
+        if key in self.new:
+            emission = self.new[key]
+        else:
+            emission = self.store.get(key)
+
+        return torch.from_numpy(emission.astype(np.float32)).log_softmax(dim=1)
+
+    def put(self, key, emission):
+        # stored relative to the best label of each step: float16 is most precise near 0,
+        # so the best label of a step stays the best (greedy decoding doesn't change)
+        emission = emission - emission.max(dim=1, keepdim=True)[0]
+        self.new[key] = emission.cpu().numpy().astype(np.float16)
+
+    def save(self):
+        if not self.new:
+            return
+
+        # older versions of the same files are dropped
+        new_paths = {key.split("|")[0] for key in self.new}
+        items = []
+        if self.store is not None:
+            items = [(key, self.store.get(key)) for key in self.store.keys if key.split("|")[0] not in new_paths]
+
+        items += list(self.new.items())
+        write_packed_store(self.store_path, items, dtype=np.float16)
+        print("Emissions cached:", self.store_path, len(items), "utterances")
+
+        self.store = PackedStore(self.store_path)
+        self.new = {}
@@ -0,0 +1,70 @@
+import os
+import pickle
+import numpy as np
+import sys
+
+sys.path.append("..")
+from config import *
+from processing_tools import get_images
+from utils import ProgressPrinter, get_split_df, get_video_path, get_frame_store_path
+from packed_store import write_packed_store
+
+
+# Decodes every video once into a uint8 frame store (see packed_store.py), already resized to the STF input size,
+# so raw End2End and GR training read frames from a memory map instead of re-decoding mp4s every epoch.
+
+def get_frame_size(stf_type=STF_TYPE):
+    img_size = IMG_SIZE_2D if stf_type == 0 else IMG_SIZE_2Plus1D
+    return img_size, img_size
+
+
+def frames_gen(video_paths, size):
+    pp = ProgressPrinter(len(video_paths), 10)
+    for idx, video_path in enumerate(video_paths):
+        images = get_images(video_path, size=size)
+        if not images:
+            pp.omit()
+            continue
+
+        yield video_path, np.stack(images)
+
+        if SHOW_PROGRESS:
+            pp.show(idx)
+
+    if SHOW_PROGRESS:
+        pp.end()
+
+
+def generate_frame_store_split(split, stf_type=STF_TYPE):
+    if SOURCE == "KRSL" and split == "dev":
+        split = "val"
+
+    df = get_split_df(split)
+    video_paths = [get_video_path(df.iloc[idx], split)[0] for idx in range(df.shape[0])]
+
+    print(SOURCE, "frame store:", split, "split")
+    store_path = get_frame_store_path(split, stf_type)
+    n = write_packed_store(store_path, frames_gen(video_paths, get_frame_size(stf_type)), np.uint8)
+    print("Stored", n, "videos into", store_path)
+
+
+def generate_frame_store(stf_type=STF_TYPE):
+    generate_frame_store_split("train", stf_type)
+    generate_frame_store_split("test", stf_type)
+    generate_frame_store_split("dev", stf_type)
+
+
+def generate_gr_frame_store(stf_type=STF_TYPE):
+    # GR videos are regenerated on every iteration, so this store has to be rebuilt after generate_gloss_dataset
+    data_path = os.sep.join([GR_DATASET_DIR, "VARS", "data.pkl"])
+    with open(data_path, 'rb') as f:
+        video_paths = pickle.load(f)["X"]
+
+    print("GR frame store")
+    store_path = get_frame_store_path("GR", stf_type)
+    n = write_packed_store(store_path, frames_gen(video_paths, get_frame_size(stf_type)), np.uint8)
+    print("Stored", n, "videos into", store_path)
+
+
+if __name__ == "__main__":
+    generate_frame_store()
@@ -1,4 +1,5 @@
 import shutil
+from functools import partial
 import cv2
 import torch
 import pickle
@@ -10,9 +11,11 @@ import sys
 sys.path.append("..")
 from config import *
 from models import get_end2end_model
-from utils import ProgressPrinter, get_video_path, get_split_df
+from utils import ProgressPrinter, get_video_path, get_split_df, get_packed_feats_path
 from processing_tools import get_tensor_video, get_images, preprocess_3d
-from vocab import Vocab, force_alignment
+from vocab import Vocab, force_alignment, ctc_forced_align
+from feature_extraction.frame_store import generate_gr_frame_store
+from emissions import EmissionCache, get_model_hash, get_emission_key, pad_emissions
 
 
 def pad_images(images, stride):
@@ -76,15 +79,29 @@ def shuffle_and_save_dataset(X, X_lens, Y):
         pickle.dump(data, f)
 
 
-def get_decoded_prediction(model, tensor_video, gt):
+def get_emissions(model, X_batch, X_lens):
+    # (T_out, V) log probabilities of every utterance of a padded batch
     with torch.no_grad():
-        pred = model(tensor_video).squeeze(1).log_softmax(dim=1).argmax(dim=1).cpu().numpy()
-        pred = force_alignment(pred, gt)
-        glosses = []
-        for i in range(len(pred)):
-            gloss = pred[i]
-            glosses.append(gloss)
-        return glosses
+        preds = model(X_batch, X_lens).log_softmax(dim=2)
+        out_lens = torch.clamp(model.get_out_lengths(X_lens), 1, preds.size(0)).tolist()
+
+    return [preds[:out_lens[b], b].cpu() for b in range(preds.size(1))]
+
+
+def get_aligned_labels(emissions, gts):
+    # label of every output step of the utterances: CTC Viterbi alignment of their log probabilities against
+    # the glosses, utterances with more glosses than steps fall back to the greedy prediction + heuristics
+    log_probs, lens = pad_emissions(emissions)
+    alignments = ctc_forced_align(log_probs.permute(1, 0, 2), lens, gts)
+
+    labels = []
+    for b, alignment in enumerate(alignments):
+        if alignment is None:
+            pred = emissions[b].argmax(dim=1).numpy()
+            alignment = force_alignment(pred, gts[b])
+        labels.append([int(label) for label in alignment])
+
+    return labels
 
 
 def generate_gloss_dataset(vocab, stf_type=STF_TYPE, use_feat=USE_ST_FEAT):
@@ -117,6 +134,40 @@ def generate_gloss_dataset(vocab, stf_type=STF_TYPE, use_feat=USE_ST_FEAT):
     X = []
     X_lens = []
 
+    # features of several utterances are aligned in one padded batch, raw videos one by one,
+    # inputs are only loaded for utterances whose emissions aren't cached
+    batch_size = GR_ALIGN_BATCH_SIZE if use_feat else 1
+    cache = EmissionCache(get_model_hash(model), "train") if EMISSION_CACHE else None
+    packed_path = get_packed_feats_path("train") if use_feat and FEAT_PACKED else None
+    pending = []
+
+    def flush():
+        emissions = [cache.get(item[0]) if cache is not None and item[0] in cache else None for item in pending]
+        missing = [k for k, emission in enumerate(emissions) if emission is None]
+        if missing:
+            videos = [pending[k][1]() for k in missing]
+            time_dim = 1 if (not use_feat and mode == "3D") else 0
+            lens = torch.LongTensor([video.size(time_dim) for video in videos])
+            if len(videos) == 1:
+                X_batch = videos[0].unsqueeze(0)
+            else:
+                X_batch = torch.nn.utils.rnn.pad_sequence(videos, batch_first=True)
+
+            for k, emission in zip(missing, get_emissions(model, X_batch.to(DEVICE), lens.to(DEVICE))):
+                emissions[k] = emission
+                if cache is not None:
+                    cache.put(pending[k][0], emission)
+
+        labels = get_aligned_labels(emissions, [item[2] for item in pending])
+        for (key, load_video, gt, gloss_paths, gloss_lens), video_labels in zip(pending, labels):
+            X.extend(gloss_paths)
+            X_lens.extend(gloss_lens)
+            Y.extend(video_labels)
+
+            assert (len(Y) == len(X) == len(X_lens))
+
+        pending.clear()
+
     pp = ProgressPrinter(df.shape[0], 5)
     cur_n_gloss = 0
     for idx in range(df.shape[0]):
@@ -133,8 +184,7 @@ def generate_gloss_dataset(vocab, stf_type=STF_TYPE, use_feat=USE_ST_FEAT):
             gloss_paths = feats_rerun_data["gloss_paths"][idx]
             gloss_lens = feats_rerun_data["gloss_lens"][idx]
 
-            with torch.no_grad():
-                tensor_video = torch.load(feat_path).unsqueeze(0).to(DEVICE)
+            load_video = partial(torch.load, feat_path)
 
         else:
             images = get_images(video_path)
@@ -151,22 +201,26 @@ def generate_gloss_dataset(vocab, stf_type=STF_TYPE, use_feat=USE_ST_FEAT):
             feats_rerun_data["gloss_paths"].append(gloss_paths)
             feats_rerun_data["gloss_lens"].append(gloss_lens)
 
-            with torch.no_grad():
-                if use_feat:
-                    tensor_video = torch.load(feat_path).unsqueeze(0).to(DEVICE)
-                else:
-                    tensor_video = get_tensor_video(images, preprocess_3d, mode).unsqueeze(0).to(DEVICE)
-
-        X += gloss_paths
-        X_lens += gloss_lens
-        Y += get_decoded_prediction(model, tensor_video, vocab.encode(row.annotation))
+            if use_feat:
+                load_video = partial(torch.load, feat_path)
+            else:
+                load_video = partial(get_tensor_video, images, preprocess_3d, mode)
 
-        assert (len(Y) == len(X) == len(X_lens))
+        key = get_emission_key(feat_path, packed_path) if use_feat else get_emission_key(video_path)
+        pending.append((key, load_video, vocab.encode(row.annotation), gloss_paths, gloss_lens))
+        if len(pending) >= batch_size:
+            flush()
 
-        cur_n_gloss = len(X)
+        cur_n_gloss += len(gloss_paths)
         if SHOW_PROGRESS:
             pp.show(idx)
 
+    if pending:
+        flush()
+
+    if cache is not None:
+        cache.save()
+
     shuffle_and_save_dataset(X, X_lens, Y)
     if use_feat and not stf_rerun:
         if not os.path.exists(rerun_out_dir): os.makedirs(rerun_out_dir)
@@ -176,6 +230,9 @@ def generate_gloss_dataset(vocab, stf_type=STF_TYPE, use_feat=USE_ST_FEAT):
     if SHOW_PROGRESS:
         pp.end()
 
+    if USE_FRAME_STORE:
+        generate_gr_frame_store(stf_type)
+
 
 if __name__ == "__main__":
     vocab = Vocab()
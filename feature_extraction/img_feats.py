@@ -1,14 +1,18 @@
 import torch
+import numpy as np
 import sys
 
 sys.path.append("..")
-from processing_tools import preprocess_2d, get_images, get_tensor_video
-from utils import ProgressPrinter, get_video_path, get_split_df
+from processing_tools import preprocess_2d, preprocess_clip
+from utils import get_video_path, get_split_df
 from models import ImgFeat
+from feature_extraction.stf_feats import pack_feats
+from feature_extraction.pipeline import extract_feats
+from feature_extraction.shards import parse_shard_args, in_shard, ShardJournal, clear_journals
 from config import *
 
 
-def generate_img_feats():
+def generate_img_feats(shard=(0, 1)):
     model = None
     preprocess = preprocess_2d
     if STF_MODEL.startswith("densenet") or STF_MODEL.startswith("googlenet"):
@@ -20,49 +24,58 @@ def generate_img_feats():
     model.eval()
 
     with torch.no_grad():
-        gen_img_feat_split(model, preprocess, "train")
-        gen_img_feat_split(model, preprocess, "test")
-        gen_img_feat_split(model, preprocess, "dev")
+        gen_img_feat_split(model, preprocess, "train", shard)
+        gen_img_feat_split(model, preprocess, "test", shard)
+        gen_img_feat_split(model, preprocess, "dev", shard)
 
+    clear_journals("IMG_" + STF_MODEL, shard)
 
-def gen_img_feat_split(model, preprocess, split):
+    if FEAT_PACKED:
+        if shard[1] > 1:
+            print("Pack the features (--pack) once all shards are done")
+        else:
+            pack_feats(stf_feat=False)
+
+
+def gen_img_feat_split(model, preprocess, split, shard=(0, 1)):
     if SOURCE == "KRSL" and split == "dev":
         split = "val"
 
     df = get_split_df(split)
+    # ImageNet weights, they never change
+    journal = ShardJournal("IMG_" + STF_MODEL, split, shard, "pretrained")
 
     print(SOURCE, STF_MODEL, "feature extraction:", split, "split")
-    L = df.shape[0]
+    tasks = []
+    for idx in range(df.shape[0]):
+        if not in_shard(idx, shard):
+            continue
 
-    pp = ProgressPrinter(L, 10)
-    for idx in range(L):
         row = df.iloc[idx]
         video_path, feat_path = get_video_path(row, split, stf_feat=False)
-        if os.path.exists(feat_path) and not FEAT_OVERRIDE:
-            pp.omit()
-            continue
-
-        feat_dir = os.path.split(feat_path)[0]
-
-        images = get_images(video_path)
-        if len(images) < 4:
+        if (os.path.exists(feat_path) and not FEAT_OVERRIDE) or feat_path in journal:
             continue
 
-        tensor_video = get_tensor_video(images, preprocess, "2D")
-        inp = tensor_video.to(DEVICE)
-        feat = model(inp).cpu()
+        tasks.append((video_path, feat_path))
 
-        if not os.path.exists(feat_dir):
-            os.makedirs(feat_dir)
+    if len(journal):
+        print("Resuming,", len(journal), "videos already done")
 
-        torch.save(feat, feat_path)
+    def infer(clips):
+        # per-frame model, frames of all clips in one forward
+        inp = torch.from_numpy(preprocess_clip(np.concatenate(clips), preprocess, channels_first=False))
+        feats = model(inp.to(DEVICE)).cpu()
+        return torch.split(feats, [len(clip) for clip in clips])
 
-        if SHOW_PROGRESS:
-            pp.show(idx)
-
-    if SHOW_PROGRESS:
-        pp.end()
+    try:
+        extract_feats(tasks, IMG_SIZE_2D, infer, journal=journal)
+    finally:
+        journal.close()
 
 
 if __name__ == "__main__":
-    generate_img_feats()
+    args = parse_shard_args()
+    if args.pack:
+        pack_feats(stf_feat=False)
+    else:
+        generate_img_feats(shard=args.shard)
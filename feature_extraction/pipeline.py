@@ -0,0 +1,123 @@
+import time
+import threading
+import queue
+import numpy as np
+import torch
+from collections import deque
+from multiprocessing import Pool
+import sys
+
+sys.path.append("..")
+from config import *
+from processing_tools import get_images
+from utils import ProgressPrinter, atomic_save
+
+
+# Three stage feature extraction:
+#   decoding  - a process pool decodes (and resizes) videos, at most FEAT_DECODE_DEPTH clips ahead of the model
+#   inference - clips of several videos go through the model together, up to FEAT_FRAME_BUDGET frames per forward
+#   writing   - a background thread saves the features while the next batch runs
+
+def _decode_worker(args):
+    video_path, img_size = args
+    images = get_images(video_path, size=(img_size, img_size))
+    if len(images) < 4:
+        return None
+
+    # uint8 frames travel between processes, normalization happens right before the forward
+    return np.stack(images)
+
+
+def _writer_worker(write_queue, errors, journal):
+    while True:
+        item = write_queue.get()
+        if item is None:
+            break
+
+        feat_path, feat = item
+        try:
+            atomic_save(feat_path, lambda f: torch.save(feat, f))
+            if journal is not None:
+                journal.mark_done(feat_path)
+        except Exception as e:
+            errors.append(e)
+
+
+def extract_feats(tasks, img_size, infer, same_len=False, frame_budget=FEAT_FRAME_BUDGET,
+                  n_workers=FEAT_DECODE_WORKERS, depth=FEAT_DECODE_DEPTH, journal=None):
+    # tasks: (video_path, feat_path) pairs
+    # infer: list of (T, H, W, 3) uint8 clips -> list of per-video features, the same as running them one by one
+    # same_len: the model only batches clips of equal length (temporal convolutions), clips wait in per-length
+    #           groups, the largest group is flushed whenever more than frame_budget frames are waiting
+    # journal: ShardJournal the saved features are recorded in (see shards.py)
+    start_time = time.time()
+    pp = ProgressPrinter(len(tasks), 10)
+    n_videos = 0
+    n_frames = 0
+
+    write_queue = queue.Queue(maxsize=max(depth, 1))
+    errors = []
+    writer = threading.Thread(target=_writer_worker, args=(write_queue, errors, journal), daemon=True)
+    writer.start()
+
+    groups = {}
+    group_frames = {}
+
+    def flush(key):
+        clips = groups.pop(key)
+        group_frames.pop(key)
+        feats = infer([clip for feat_path, clip in clips])
+        for (feat_path, clip), feat in zip(clips, feats):
+            # clone => the saved tensor doesn't drag the whole batch output storage along
+            write_queue.put((feat_path, feat.clone()))
+
+    pool = Pool(n_workers)
+    results = deque()
+    next_idx = 0
+    try:
+        while next_idx < len(tasks) and len(results) < depth:
+            results.append(pool.apply_async(_decode_worker, ((tasks[next_idx][0], img_size),)))
+            next_idx += 1
+
+        for idx in range(len(tasks)):
+            clip = results.popleft().get()
+            if next_idx < len(tasks):
+                results.append(pool.apply_async(_decode_worker, ((tasks[next_idx][0], img_size),)))
+                next_idx += 1
+
+            if clip is None:
+                pp.omit()
+                continue
+
+            key = len(clip) if same_len else 0
+            if key in groups and group_frames[key] + len(clip) > frame_budget:
+                flush(key)
+
+            groups.setdefault(key, []).append((tasks[idx][1], clip))
+            group_frames[key] = group_frames.get(key, 0) + len(clip)
+            while group_frames and sum(group_frames.values()) > frame_budget:
+                flush(max(group_frames, key=group_frames.get))
+
+            n_videos += 1
+            n_frames += len(clip)
+
+            if SHOW_PROGRESS:
+                pp.show(idx)
+
+        for key in list(groups):
+            flush(key)
+    finally:
+        pool.terminate()
+        write_queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    if SHOW_PROGRESS:
+        pp.end()
+
+    extraction_time = time.time() - start_time
+    print("Extracted", n_videos, "videos in %.1fs:" % extraction_time,
+          "%.2f videos/s," % (n_videos / max(extraction_time, 1e-6)),
+          "%.1f frames/s" % (n_frames / max(extraction_time, 1e-6)))
@@ -2,12 +2,17 @@ import torch
 import sys
 import numpy as np
 import cv2
-from utils import ProgressPrinter, get_split_df, get_video_path
+import glob
+from utils import ProgressPrinter, get_split_df, get_video_path, atomic_save
 import sys
 
 sys.path.append("..")
 from config import *
 
+from feature_extraction.shards import parse_shard_args, in_shard, ShardJournal, clear_journals
+from feature_extraction.stf_feats import pack_feats
+from processing_tools import is_png_video
+
 sys.path.append(os.path.join(OPENPOSE_FOLDER, "build/python"))
 from openpose import pyopenpose as op
 
@@ -37,6 +42,10 @@ class PoseEstimator():
     def estimate_video_pose(self, video):
         video_pose = []
 
+        if isinstance(video, str) and is_png_video(video):
+            # PHOENIX frames (PH_FRAME_BACKEND = "png"), cv2.VideoCapture can't read the glob
+            video = sorted(glob.glob(video))
+
         if isinstance(video, list):
             for image_file in video:
                 frame = cv2.imread(image_file)
@@ -86,44 +95,56 @@ class PoseEstimator():
         return np.vstack((face, body, hleft, hright)).reshape(-1)
 
 
-def generate_openpose_features_split(pose_estimator, split):
+def generate_openpose_features_split(pose_estimator, split, shard=(0, 1)):
     with torch.no_grad():
         df = get_split_df(split)
+        journal = ShardJournal("POSE", split, shard, "openpose")
         print(SOURCE, "Feature extraction:", STF_MODEL, split, "split")
         L = df.shape[0]
 
         pp = ProgressPrinter(L, 1)
         for idx in range(L):
             row = df.iloc[idx]
-            video_dir, feat_path = get_video_path(row, split, feat_ext=".npy")
+            # where End2EndImgFeatDataset reads pose features from
+            video_dir, feat_path = get_video_path(row, split, stf_feat=False, feat_ext=".npy")
 
-            if os.path.exists(feat_path):
+            if not in_shard(idx, shard) or os.path.exists(feat_path) or feat_path in journal:
                 pp.omit()
                 continue
 
-            feat_dir = os.path.split(feat_path)[0]
-
             feats = pose_estimator.estimate_video_pose(video_dir)
+            if len(feats) == 0:
+                print("No pose estimated, not saved:", video_dir)
+                continue
 
-            if not os.path.exists(feat_dir):
-                os.makedirs(feat_dir)
-            np.save(feat_path, feats)
+            atomic_save(feat_path, lambda f: np.save(f, feats))
+            journal.mark_done(feat_path)
 
             if SHOW_PROGRESS:
                 pp.show(idx)
 
+        journal.close()
+
         if SHOW_PROGRESS:
             pp.end()
 
         print()
 
 
-def generate_openpose_features():
+def generate_openpose_features(shard=(0, 1)):
     pose_estimator = PoseEstimator()
-    generate_openpose_features_split(pose_estimator, "train")
-    generate_openpose_features_split(pose_estimator, "dev")
-    generate_openpose_features_split(pose_estimator, "test")
+    generate_openpose_features_split(pose_estimator, "train", shard)
+    generate_openpose_features_split(pose_estimator, "dev", shard)
+    generate_openpose_features_split(pose_estimator, "test", shard)
+    clear_journals("POSE", shard)
+
+    if FEAT_PACKED and shard[1] == 1:
+        pack_feats(stf_feat=False)
 
 
 if __name__ == "__main__":
-    generate_openpose_features()
+    args = parse_shard_args()
+    if args.pack:
+        pack_feats(stf_feat=False)
+    else:
+        generate_openpose_features(shard=args.shard)
@@ -0,0 +1,95 @@
+import os
+import argparse
+import sys
+
+sys.path.append("..")
+from config import *
+
+
+# Feature extraction split over processes/machines: "--shard i/N" takes every N-th row of a split, starting at row i.
+# Features are written to a temporary file and renamed, and every shard keeps a journal of the features it finished,
+# so a killed job resumes where it stopped (also with FEAT_OVERRIDE, which ignores existing files).
+
+def parse_shard_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shard", default="0/1", help="i/N: extract the i-th of N shards of every split")
+    parser.add_argument("--pack", action="store_true", help="only pack the extracted features (after all shards)")
+    args = parser.parse_args()
+
+    try:
+        i, n = [int(x) for x in args.shard.split("/")]
+    except ValueError:
+        i, n = -1, 0
+
+    if not 0 <= i < n:
+        print("Incorrect shard:", args.shard, "(expected i/N with 0 <= i < N)")
+        exit(0)
+
+    args.shard = (i, n)
+    return args
+
+
+def in_shard(idx, shard):
+    i, n = shard
+    return idx % n == i
+
+
+def get_model_tag(model_path):
+    # identifies the weights the features come from, a new checkpoint invalidates the journals
+    if not os.path.exists(model_path):
+        return "pretrained"
+
+    stat = os.stat(model_path)
+    return "%s_%d_%d" % (os.path.basename(model_path), stat.st_size, int(stat.st_mtime))
+
+
+def clear_journals(name, shard):
+    # after a complete run, so the next one (with FEAT_OVERRIDE) extracts everything again
+    journal_dir = os.path.join(FEAT_JOURNAL_DIR, name)
+    suffix = "_%d_of_%d.txt" % shard
+    if os.path.exists(journal_dir):
+        for filename in os.listdir(journal_dir):
+            if filename.endswith(suffix):
+                os.remove(os.path.join(journal_dir, filename))
+
+
+class ShardJournal():
+    # one line per finished feature file, after a header line with the model tag
+    def __init__(self, name, split, shard, tag):
+        journal_dir = os.path.join(FEAT_JOURNAL_DIR, name)
+        if not os.path.exists(journal_dir):
+            os.makedirs(journal_dir, exist_ok=True)
+
+        self.path = os.path.join(journal_dir, "%s_%d_of_%d.txt" % (split, shard[0], shard[1]))
+        self.done = set()
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                lines = f.read().splitlines()
+
+            # a truncated last line (killed while writing) never matches a path, that file is just redone
+            if lines and lines[0] == tag:
+                self.done = set(lines[1:])
+            else:
+                print("Journal", self.path, "is from another model, starting over")
+
+        if self.done:
+            self.f = open(self.path, 'a')
+        else:
+            self.f = open(self.path, 'w')
+            self.f.write(tag + "\n")
+            self.f.flush()
+
+    def __contains__(self, feat_path):
+        return feat_path in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def mark_done(self, feat_path):
+        self.done.add(feat_path)
+        self.f.write(feat_path + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
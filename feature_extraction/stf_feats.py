@@ -1,13 +1,18 @@
 import torch
+import numpy as np
 import sys
 sys.path.append("..")
-from processing_tools import preprocess_2d, preprocess_3d, get_images, get_tensor_video
-from utils import ProgressPrinter, get_video_path, get_split_df
+from processing_tools import preprocess_2d, preprocess_3d, preprocess_clip, get_pose_selection, select_pose_keypoints
+from utils import ProgressPrinter, get_video_path, get_split_df, get_packed_feats_path
 from models import STF_2D, STF_2Plus1D
+from packed_store import write_packed_store
+from feature_extraction.pipeline import extract_feats
+from feature_extraction.shards import parse_shard_args, in_shard, get_model_tag, ShardJournal, clear_journals
 from config import *
 
 
-def generate_stf_feats(stf_model=STF_MODEL):
+def generate_stf_feats(stf_model=STF_MODEL, shard=(0, 1)):
+    # shard: (i, N), only every N-th video of each split starting at i (see shards.py)
     if not os.path.exists(STF_MODEL_PATH) and not stf_model.startswith("resnet{2+1}d"):
         print("STF model doesnt exist:", STF_MODEL_PATH)
         exit(0)
@@ -35,50 +40,133 @@ def generate_stf_feats(stf_model=STF_MODEL):
         print("Model not Loaded")
     model.eval()
     print(SOURCE, stf_model, "SpatioTemporal feature extraction...")
+    if shard[1] > 1:
+        print("Shard", shard[0], "of", shard[1])
+
+    tag = get_model_tag(STF_MODEL_PATH)
     with torch.no_grad():
 
-        gen_stf_feats_split(model, preprocess, "train", mode)
-        gen_stf_feats_split(model, preprocess, "test", mode)
-        gen_stf_feats_split(model, preprocess, "dev", mode)
+        gen_stf_feats_split(model, preprocess, "train", mode, shard, tag, stf_model)
+        gen_stf_feats_split(model, preprocess, "test", mode, shard, tag, stf_model)
+        gen_stf_feats_split(model, preprocess, "dev", mode, shard, tag, stf_model)
+
+    clear_journals("STF_" + stf_model, shard)
+
+    if FEAT_PACKED:
+        if shard[1] > 1:
+            print("Pack the features (--pack) once all shards are done")
+        else:
+            pack_feats()
+
+
+def get_stf_infer(model, preprocess, mode):
+    # batched forward over clips of several videos, each video's features equal a forward of it alone
+    def infer_2d(clips):
+        # frames of all clips through the image model at once, temporal fusion per video
+        inp = torch.from_numpy(preprocess_clip(np.concatenate(clips), preprocess, channels_first=False))
+        img_feats = model.spatial_feat_m(inp.to(DEVICE))
+        feats = []
+        s = 0
+        for clip in clips:
+            x = img_feats[s:s + len(clip)].view(1, 1, len(clip), -1)
+            feats.append(model.temporal_feat_m(x).squeeze(1).squeeze(0).cpu())
+            s += len(clip)
 
+        return feats
 
-def gen_stf_feats_split(model, preprocess, split, mode):
+    def infer_3d(clips):
+        # clips have equal length
+        inp = np.empty((len(clips), 3) + clips[0].shape[:3], dtype=np.float32)
+        for idx, clip in enumerate(clips):
+            preprocess_clip(clip, preprocess, channels_first=True, out=inp[idx])
+
+        return list(model(torch.from_numpy(inp).to(DEVICE)).cpu())
+
+    return infer_2d if mode == "2D" else infer_3d
+
+
+def gen_stf_feats_split(model, preprocess, split, mode, shard=(0, 1), tag="pretrained", stf_model=STF_MODEL):
     if SOURCE == "KRSL" and split == "dev":
         split = "val"
 
     df = get_split_df(split)
+    journal = ShardJournal("STF_" + stf_model, split, shard, tag)
 
-    L = df.shape[0]
     print(split, "split")
-    pp = ProgressPrinter(L, 10)
-    for idx in range(L):
+    tasks = []
+    for idx in range(df.shape[0]):
+        if not in_shard(idx, shard):
+            continue
+
         row = df.iloc[idx]
         video_path, feat_path = get_video_path(row, split)
 
-        if os.path.exists(feat_path) and not FEAT_OVERRIDE:
-            pp.omit()
+        if (os.path.exists(feat_path) and not FEAT_OVERRIDE) or feat_path in journal:
             continue
 
-        feat_dir = os.path.split(feat_path)[0]
+        tasks.append((video_path, feat_path))
 
-        images = get_images(video_path)
-        if len(images) < 4:
-            continue
+    if len(journal):
+        print("Resuming,", len(journal), "videos already done")
+
+    img_size = IMG_SIZE_2D if mode == "2D" else IMG_SIZE_2Plus1D
+    try:
+        extract_feats(tasks, img_size, get_stf_infer(model, preprocess, mode), same_len=mode != "2D", journal=journal)
+    finally:
+        journal.close()
 
-        tensor_video = get_tensor_video(images, preprocess, mode)
-        inp = tensor_video.unsqueeze(0).to(DEVICE)
-        feat = model(inp).squeeze(0).cpu()
-        if not os.path.exists(feat_dir):
-            os.makedirs(feat_dir)
 
-        torch.save(feat, feat_path)
+def pack_feats_split(split, stf_feat=True):
+    if SOURCE == "KRSL" and split == "dev":
+        split = "val"
+
+    df = get_split_df(split)
+    dtype = np.float16 if FEAT_PACKED_FP16 else np.float32
+    store_path = get_packed_feats_path(split, stf_feat)
+    # openpose .npy files, only the selected keypoint coordinates are packed
+    pose = not stf_feat and STF_MODEL.startswith("pose")
+    pose_idxs = get_pose_selection()[0] if pose else None
+
+    def feats_gen():
+        pp = ProgressPrinter(df.shape[0], 10)
+        for idx in range(df.shape[0]):
+            row = df.iloc[idx]
+            video_path, feat_path = get_video_path(row, split, stf_feat=stf_feat, feat_ext=".npy" if pose else ".pt")
+            if not os.path.exists(feat_path):
+                pp.omit()
+                continue
+
+            feat = np.load(feat_path) if pose else torch.load(feat_path).numpy()
+            if len(feat.shape) < 2:
+                pp.omit()
+                continue
+
+            if pose:
+                feat = select_pose_keypoints(feat, pose_idxs)
+                feat = feat.reshape(len(feat), -1)
+
+            yield feat_path, feat
+
+            if SHOW_PROGRESS:
+                pp.show(idx)
 
         if SHOW_PROGRESS:
-            pp.show(idx)
+            pp.end()
+
+    print("Packing", split, "split")
+    n = write_packed_store(store_path, feats_gen(), dtype)
+    print("Packed", n, "videos into", store_path)
 
-    if SHOW_PROGRESS:
-        pp.end()
+
+def pack_feats(stf_feat=True):
+    pack_feats_split("train", stf_feat)
+    pack_feats_split("test", stf_feat)
+    pack_feats_split("dev", stf_feat)
 
 
 if __name__ == "__main__":
-    generate_stf_feats()
+    args = parse_shard_args()
+    if args.pack:
+        pack_feats()
+    else:
+        generate_stf_feats(shard=args.shard)
@@ -45,14 +45,16 @@ class BiLSTM(nn.Module):
 
     def forward(self, x, x_lengths=None):
         # (max_seq_length // 4, batch_size, 1024)
+        # x_lengths: true lengths of the zero padded sequences, padding never reaches the LSTM states
+        T = x.shape[0]
         hidden = self.init_hidden(x.shape[1])
         if x_lengths is not None:
-            x = torch.nn.utils.rnn.pack_padded_sequence(x, x_lengths, enforce_sorted=False)
+            x = torch.nn.utils.rnn.pack_padded_sequence(x, x_lengths.cpu(), enforce_sorted=False)
 
         x = self.lstm(x, hidden)[0]
 
         if x_lengths is not None:
-            x, _ = torch.nn.utils.rnn.pad_packed_sequence(x)
+            x, _ = torch.nn.utils.rnn.pad_packed_sequence(x, total_length=T)
         x = self.emb(x)
 
         return x
@@ -82,10 +84,20 @@ class SLR(nn.Module):
         self.use_img_feat = use_img_feat
         self.seq2seq = BiLSTM(rnn_hidden, vocab_size)
 
+    def get_out_lengths(self, x_lengths):
+        # number of output steps of every input length
+        if self.use_st_feat:
+            return x_lengths
+
+        return self.stf.out_lengths(x_lengths)
+
     def forward(self, x, x_lengths=None):
+        # x_lengths: true input lengths of a zero padded batch
         # (batch_size, max_seq_length // 4, 1024)
         x = self.stf(x)
         x = x.permute(1, 0, 2)
+        if x_lengths is not None:
+            x_lengths = torch.clamp(self.get_out_lengths(x_lengths), 1, x.shape[0])
         # (max_seq_length // 4, batch_size, 1024)
         x = self.seq2seq(x, x_lengths)
         return x
@@ -112,12 +124,48 @@ class GR(nn.Module):
 
 
 class STF_2Plus1D(nn.Module):
-    def __init__(self):
+    # Temporal receptive field of one output step, stem through layer3, is +-26 frames around frame 4 * k
+    # (stem 1, layer1 4, layer2 1 + 2 * 3, layer3 2 + 4 * 3). Windows carry CONTEXT >= 26 extra frames on both
+    # sides and start at multiples of 4, so every kept output sees exactly the frames it sees in a full forward.
+    # The outputs equal the full forward's up to float noise: the convolution algorithm (cuDNN) can change with the
+    # input length, check_stf_windowed_parity asserts them allclose
+    CONTEXT = 28
+
+    def __init__(self, window=STF_WINDOW):
         super(STF_2Plus1D, self).__init__()
         self.cnn = models.video.r2plus1d_18(pretrained=True)
         self.avgpool = nn.AvgPool3d(kernel_size=(1, 7, 7))
+        # eval forward over long videos in overlapping windows of window + 2 * CONTEXT frames (None => whole video)
+        self.window = window
+
+    def out_lengths(self, x_lengths):
+        # layer2 and layer3 halve time with (kernel 3, stride 2, padding 1) convs => ceil(T / 4)
+        return (x_lengths + 3) // 4
 
     def forward(self, x):
+        T = x.size(2)
+        if self.window is not None and not self.training and T > self.window + 2 * self.CONTEXT:
+            return self.forward_windowed(x, self.window)
+
+        return self._forward(x)
+
+    def forward_windowed(self, x, window):
+        # peak memory is the one of a (window + 2 * CONTEXT) frames forward, whatever the video length
+        window = max(4, window // 4 * 4)
+        T = x.size(2)
+        out = []
+        for s in range(0, T, window):
+            cs = max(0, s - self.CONTEXT)
+            ce = min(T, s + window + self.CONTEXT)
+            feats = self._forward(x[:, :, cs:ce])
+            # outputs k of the window's core [s, s + window), k - cs // 4 in the context extended window
+            k_start = s // 4
+            k_end = min((T + 3) // 4, (s + window) // 4)
+            out.append(feats[:, k_start - cs // 4:k_end - cs // 4])
+
+        return torch.cat(out, dim=1)
+
+    def _forward(self, x):
         x = self.cnn.stem(x)
         x = self.cnn.layer1(x)
         x = self.cnn.layer2(x)
@@ -142,6 +190,10 @@ class STF_2D(nn.Module):
                                              nn.MaxPool2d(kernel_size=(2, 1), stride=(2, 1)))
         self.use_feat = use_feat
 
+    def out_lengths(self, x_lengths):
+        # two (2, 1) max pools => floor(T / 4)
+        return x_lengths // 4
+
     def forward(self, x):
         if not self.use_feat:
             B, T, C, X, Y = x.shape
@@ -219,6 +271,23 @@ def get_GR_model(vocab):
     return model
 
 
+def check_stf_windowed_parity(cases=((150, 32), (97, 24), (64, 16), (20, 8)), img_size=IMG_SIZE_2Plus1D, atol=1e-4):
+    # windowed vs full video STF_2Plus1D forward must only differ by float noise, (T, window) cases cover
+    # T not divisible by the window and T < CONTEXT (a single window)
+    model = STF_2Plus1D(window=None).to(DEVICE)
+    model.eval()
+    for T, window in cases:
+        x = torch.rand(1, 3, T, img_size, img_size).to(DEVICE)
+        with torch.no_grad():
+            full = model(x)
+            windowed = model.forward_windowed(x, window)
+
+        print("STF_2Plus1D windowed forward, T:", T, "window:", window, "max abs diff:",
+              (full - windowed).abs().max().item() if full.shape == windowed.shape else "shape mismatch")
+        assert full.shape == windowed.shape and torch.allclose(full, windowed, atol=atol), \
+            "windowed STF_2Plus1D forward differs from the full one, T: %d, window: %d" % (T, window)
+
+
 def weights_init(m):
     classname = m.__class__.__name__
     if type(m) in [nn.Linear, nn.Conv2d, nn.Conv1d, nn.Conv3d]:
@@ -254,3 +323,5 @@ if __name__ == "__main__":
         out = model(inp)
 
         print(out.shape)
+
+    check_stf_windowed_parity()
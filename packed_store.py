@@ -0,0 +1,142 @@
+import os
+import zlib
+import pickle
+import numpy as np
+import torch
+
+
+# Variable-length arrays (features, frames, ...) packed into one contiguous memory-mapped file.
+# <store_path>.bin holds the rows of every item back to back, <store_path>.pkl holds the keys,
+# offsets and lengths, so an item is a zero-copy slice of the memory map instead of a file open + unpickle.
+
+def packed_store_exists(store_path):
+    return os.path.exists(store_path + ".bin") and os.path.exists(store_path + ".pkl")
+
+
+def write_packed_store(store_path, items, dtype=np.float32):
+    # items: iterable of (key, array), arrays must share the trailing shape
+    store_dir = os.path.split(store_path)[0]
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    keys = []
+    offsets = []
+    lengths = []
+    item_shape = None
+    offset = 0
+
+    tmp_path = store_path + ".bin.tmp"
+    with open(tmp_path, 'wb') as f:
+        for key, arr in items:
+            arr = np.ascontiguousarray(arr, dtype=dtype)
+            if item_shape is None:
+                item_shape = arr.shape[1:]
+            elif arr.shape[1:] != item_shape:
+                print("Skipping", key, "wrong shape:", arr.shape)
+                continue
+
+            f.write(arr.tobytes())
+            keys.append(key)
+            offsets.append(offset)
+            lengths.append(len(arr))
+            offset += len(arr)
+
+    index = {"keys": keys, "offsets": np.array(offsets, dtype=np.int64),
+             "lengths": np.array(lengths, dtype=np.int64),
+             "dtype": np.dtype(dtype).str, "shape": (offset,) + tuple(item_shape or ()),
+             "nbytes": os.path.getsize(tmp_path), "checksum": get_data_checksum(tmp_path)}
+
+    tmp_index_path = store_path + ".pkl.tmp"
+    with open(tmp_index_path, 'wb') as f:
+        pickle.dump(index, f)
+
+    # both files are swapped in whole, a reader catching the data and index of different writes
+    # (or a write killed in between) fails the size/checksum check of PackedStore
+    _opened_stores.pop(store_path, None)
+    os.replace(tmp_path, store_path + ".bin")
+    os.replace(tmp_index_path, store_path + ".pkl")
+
+    return len(keys)
+
+
+def get_data_checksum(data_path, n_bytes=1 << 16):
+    # crc32 of the first and last n_bytes of the data file
+    with open(data_path, 'rb') as f:
+        checksum = zlib.crc32(f.read(n_bytes))
+        f.seek(max(os.path.getsize(data_path) - n_bytes, 0))
+        return zlib.crc32(f.read(n_bytes), checksum)
+
+
+_opened_stores = {}
+
+
+def get_store_version(store_path):
+    stat = os.stat(store_path + ".bin")
+    index_stat = os.stat(store_path + ".pkl")
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size, index_stat.st_ino, index_stat.st_mtime_ns
+
+
+def open_packed_store(store_path):
+    # one instance per process (for pool workers that only receive the store path),
+    # a store rewritten since it was opened is opened again
+    version = get_store_version(store_path)
+    if store_path not in _opened_stores or _opened_stores[store_path][0] != version:
+        _opened_stores[store_path] = (version, PackedStore(store_path))
+    return _opened_stores[store_path][1]
+
+
+class PackedStore():
+    def __init__(self, store_path):
+        self.store_path = store_path
+        with open(store_path + ".pkl", 'rb') as f:
+            index = pickle.load(f)
+
+        self.keys = index["keys"]
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.dtype = np.dtype(index["dtype"])
+        self.shape = tuple(index["shape"])
+        self.key2idx = {key: i for i, key in enumerate(self.keys)}
+
+        if "nbytes" in index:
+            data_path = store_path + ".bin"
+            if os.path.getsize(data_path) != index["nbytes"] or get_data_checksum(data_path) != index["checksum"]:
+                raise IOError("Packed store " + store_path + ": data and index don't match, pack it again")
+
+        self._open()
+
+    def _open(self):
+        if self.shape[0] == 0:
+            self.data = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            # copy-on-write so torch.from_numpy gets a writable view without copying the file
+            self.data = np.memmap(self.store_path + ".bin", dtype=self.dtype, mode="c", shape=self.shape)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["data"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.key2idx
+
+    def get_length(self, key):
+        return int(self.lengths[self.key2idx[key]])
+
+    def get_offset(self, key):
+        return int(self.offsets[self.key2idx[key]])
+
+    def get(self, key):
+        idx = self.key2idx[key]
+        s = self.offsets[idx]
+        return self.data[s:s + self.lengths[idx]]
+
+    def get_tensor(self, key):
+        return torch.from_numpy(self.get(key))
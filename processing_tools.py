@@ -2,7 +2,16 @@ from config import *
 import torch
 import numpy as np
 import cv2
+import time
+import glob
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+MEAN_2D = np.array([0.485, 0.456, 0.406])
+STD_2D = np.array([0.229, 0.224, 0.225])
+MEAN_3D = np.array([0.43216, 0.394666, 0.37645])
+STD_3D = np.array([0.22803, 0.22145, 0.216989])
+
 
 def preprocess_img(img, mean, std):
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -14,7 +23,7 @@ def preprocess_2d(img):
     if img.shape[:2] != (IMG_SIZE_2D, IMG_SIZE_2D):
         img = cv2.resize(img, (IMG_SIZE_2D, IMG_SIZE_2D))
 
-    img = preprocess_img(img, np.array([0.485, 0.456, 0.406]), np.array([0.229, 0.224, 0.225]))
+    img = preprocess_img(img, MEAN_2D, STD_2D)
 
     return img
 
@@ -23,29 +32,165 @@ def preprocess_3d(img):
     if img.shape[:2] != (IMG_SIZE_2Plus1D, IMG_SIZE_2Plus1D):
         img = cv2.resize(img, (IMG_SIZE_2Plus1D, IMG_SIZE_2Plus1D))
 
-    img = preprocess_img(img, np.array([0.43216, 0.394666, 0.37645]), np.array([0.22803, 0.22145, 0.216989]))
+    img = preprocess_img(img, MEAN_3D, STD_3D)
 
     return img
 
 
-def get_images(video_path, size=None):
+def is_png_video(video_path):
+    # folder of png frames given as a glob pattern, e.g. PHOENIX ".../1/*.png"
+    return video_path.endswith(".png")
+
+
+def read_png_images(image_paths, size=None):
+    def read(image_path):
+        img = cv2.imread(image_path)
+        if size is not None:
+            img = cv2.resize(img, size)
+        return img
+
+    # cv2 releases the GIL while decoding
+    with ThreadPoolExecutor(PNG_READ_THREADS) as executor:
+        return list(executor.map(read, image_paths))
+
+
+def get_images(video_path, size=None, frame_idxs=None):
+    # frame_idxs: sorted indices of the frames to keep, the others are only grabbed, never retrieved (decoded to BGR)
+    if is_png_video(video_path):
+        image_paths = sorted(glob.glob(video_path))
+        if frame_idxs is not None:
+            image_paths = [image_paths[i] for i in frame_idxs if i < len(image_paths)]
+        return read_png_images(image_paths, size)
+
     with warnings.catch_warnings():
         images = []
         cap = cv2.VideoCapture(video_path)
-        while True:
-            ret, img = cap.read()
-            if not ret:
-                break
-
-            if size is not None:
-                img = cv2.resize(img, size)
-            images.append(img)
+        if frame_idxs is None:
+            while True:
+                ret, img = cap.read()
+                if not ret:
+                    break
+
+                if size is not None:
+                    img = cv2.resize(img, size)
+                images.append(img)
+        else:
+            pos = -1
+            img = None
+            for idx in frame_idxs:
+                while pos < idx:
+                    if not cap.grab():
+                        break
+                    pos += 1
+                    img = None
+
+                if pos < idx:
+                    break
+
+                if img is None:
+                    ret, img = cap.retrieve()
+                    if not ret:
+                        break
+
+                    if size is not None:
+                        img = cv2.resize(img, size)
+                images.append(img)
         cap.release()
 
         return images
 
 
+def get_video_len(video_path):
+    # number of frames get_images would return, from the container's frame count when it checks out
+    if is_png_video(video_path):
+        return len(glob.glob(video_path))
+
+    cap = cv2.VideoCapture(video_path)
+    n = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    # the last counted frame has to exist and be the last one
+    valid = False
+    if n > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, n - 1)
+        valid = cap.grab() and not cap.grab()
+
+    if not valid:
+        cap.release()
+        cap = cv2.VideoCapture(video_path)
+        n = 0
+        while cap.grab():
+            n += 1
+
+    cap.release()
+    return n
+
+
+def get_pose_selection():
+    # indices of the openpose keypoints (70 face, 25 body, 2 x 21 hands) used as pose features
+    # and the noise amplitude of each of them
+    idxs = []
+    noise = []
+    if POSE_FACE:
+        idxs += list(range(70))
+        noise += [POSE_AUG_NOISE_HANDFACE] * 70
+
+    if POSE_BODY:
+        idxs += list(range(70, 70 + 8)) + list(range(70 + 15, 70 + 19))
+        noise += [POSE_AUG_NOISE_BODY] * 12
+
+    if POSE_HANDS:
+        idxs += list(range(95, 137))
+        noise += [POSE_AUG_NOISE_HANDFACE] * 42
+
+    return np.array(idxs), np.array(noise, dtype=np.float32)
+
+
+def select_pose_keypoints(video_pose, idxs):
+    # (T, 137 * 3) openpose output -> (T, K, 2) coordinates of the selected keypoints
+    return video_pose.reshape(-1, 137, 3)[:, idxs, :2].astype(np.float32)
+
+
+def get_norm_lut(mean, std):
+    # (3, 256) table: uint8 value -> normalized float32, per RGB channel, same arithmetic as preprocess_img
+    values = (np.arange(256, dtype=np.float32) / 255).astype(np.float64)
+    return ((values[None] - mean[:, None]) / std[:, None]).astype(np.float32)
+
+
+CLIP_PARAMS = {preprocess_2d: (IMG_SIZE_2D, get_norm_lut(MEAN_2D, STD_2D)),
+               preprocess_3d: (IMG_SIZE_2Plus1D, get_norm_lut(MEAN_3D, STD_3D))}
+
+
+def preprocess_clip(images, preprocess, channels_first, out=None):
+    # Whole clip version of preprocess_2d/preprocess_3d: images is a list or (T, H, W, 3) array of BGR uint8 frames.
+    # Resizes in uint8, then BGR->RGB swap and normalization are one table lookup per channel written
+    # directly into the output layout, (C, T, H, W) if channels_first else (T, C, H, W).
+    size, lut = CLIP_PARAMS[preprocess]
+
+    if isinstance(images, np.ndarray) and images.shape[1:3] == (size, size):
+        clip = images
+    else:
+        clip = np.stack([img if img.shape[:2] == (size, size) else cv2.resize(img, (size, size)) for img in images])
+
+    T = len(clip)
+    if out is None:
+        out = np.empty((3, T, size, size) if channels_first else (T, 3, size, size), dtype=np.float32)
+
+    for c in range(3):
+        dst = out[c] if channels_first else out[:, c]
+        np.take(lut[c], clip[..., 2 - c], out=dst, mode="clip")
+
+    return out
+
+
 def get_tensor_video(images, preprocess, mode):
+    video_tensor = preprocess_clip(images, preprocess, channels_first=mode != "2D")
+    video_tensor = torch.from_numpy(video_tensor)
+
+    return video_tensor
+
+
+def get_tensor_video_per_frame(images, preprocess, mode):
+    # frame by frame reference implementation, kept for the benchmark below
     video = []
     for img in images:
         img = preprocess(img)
@@ -62,13 +207,27 @@ def get_tensor_video(images, preprocess, mode):
     return video_tensor
 
 
+def benchmark_preprocessing(n_frames=100, n_runs=5):
+    images = [np.random.randint(0, 256, (260, 210, 3), dtype=np.uint8) for _ in range(n_frames)]
 
+    for preprocess, mode in [(preprocess_2d, "2D"), (preprocess_3d, "3D")]:
+        start_time = time.time()
+        for _ in range(n_runs):
+            ref = get_tensor_video_per_frame(images, preprocess, mode)
+        per_frame_time = (time.time() - start_time) / n_runs
 
+        start_time = time.time()
+        for _ in range(n_runs):
+            res = get_tensor_video(images, preprocess, mode)
+        clip_time = (time.time() - start_time) / n_runs
 
-
+        print(mode, n_frames, "frames:",
+              "per frame %.4fs," % per_frame_time,
+              "whole clip %.4fs," % clip_time,
+              "speedup %.2fx," % (per_frame_time / clip_time),
+              "max abs diff:", (ref - res).abs().max().item())
 
 
 if __name__ == "__main__":
     np.random.seed(0)
-
-    # print(vocab.idx2gloss)
+    benchmark_preprocessing()
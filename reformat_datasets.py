@@ -1,13 +1,56 @@
+import argparse
 import glob
 import os
+import time
 import cv2
 import numpy as np
-from config import PH_DIR, VIDEOS_DIR, KRSL_DIR, ANNO_DIR
-from utils import ProgressPrinter, get_split_df, get_video_path
+from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
+from config import PH_DIR, VIDEOS_DIR, KRSL_DIR, ANNO_DIR, REFORMAT_WORKERS, PH_VIDEO_FOURCC, PH_VIDEO_EXT
+from utils import ProgressPrinter, get_split_df, get_video_path, get_ph_video_path
+from processing_tools import get_video_len, get_images
 
 
 # Converting into folders with images into video files
 # Because it is much faster to read from cv2.VideoCapture rather than using imread on each image in folder
+# (with PH_FRAME_BACKEND = "png" the folders are read directly instead, compare both with --benchmark)
+
+def write_video(video_path, frames, fourcc, fps=25.0):
+    # frames (BGR, one size) written under a temporary name and renamed, an interrupted run never leaves a
+    # truncated video behind. False => no frames, nothing written
+    tmp_video_path = "%s.tmp%s" % os.path.splitext(video_path)
+    out = None
+    for frame in frames:
+        if out is None:
+            out = cv2.VideoWriter(tmp_video_path, cv2.VideoWriter_fourcc(*fourcc), fps, frame.shape[:2][::-1])
+        out.write(frame)
+
+    if out is None:
+        return False
+
+    out.release()
+    os.replace(tmp_video_path, video_path)
+    return True
+
+
+def convert_phoenix_video(video_dir):
+    # 0 => converted, 1 => already there, 2 => no frames
+    video_path = os.path.split(video_dir)[0] + PH_VIDEO_EXT
+    video_path = os.sep.join([VIDEOS_DIR] + video_path.split(os.sep)[-2:])
+    if os.path.exists(video_path):
+        return 1
+
+    image_paths = sorted(list(glob.glob(os.path.join(video_dir, "*.png"))))
+    if not image_paths:
+        return 2
+
+    out_dir = os.path.split(video_path)[0]
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+
+    write_video(video_path, (cv2.imread(im) for im in image_paths), PH_VIDEO_FOURCC)
+    return 0
+
 
 def convert_phoenix_to_videos():
     ph_images_dir = os.sep.join([PH_DIR, "features", "fullFrame-210x260px"])
@@ -15,33 +58,39 @@ def convert_phoenix_to_videos():
     video_dirs = list(glob.glob(os.sep.join([ph_images_dir, '*', '*', '1'])))
 
     pp = ProgressPrinter(len(video_dirs), 5)
-    print("Converting Images into Videos")
-    for idx, video_dir in enumerate(video_dirs):
-        image_paths = sorted(list(glob.glob(os.path.join(video_dir, "*.png"))))
-        video_path = os.path.split(video_dir)[0] + ".mp4"
-        video_path = os.sep.join([VIDEOS_DIR] + video_path.split(os.sep)[-2:])
-        if os.path.exists(video_path):
-            pp.omit()
-            continue
-        video_dir = os.path.split(video_path)[0]
-        if not os.path.exists(video_dir):
-            os.makedirs(video_dir)
+    print("Converting Images into Videos", "(" + PH_VIDEO_FOURCC + ", " + PH_VIDEO_EXT + ")")
+    with Pool(REFORMAT_WORKERS) as pool:
+        for idx, status in enumerate(pool.imap_unordered(convert_phoenix_video, video_dirs, chunksize=4)):
+            if status:
+                pp.omit()
+            else:
+                pp.show(idx)
 
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    pp.end()
 
-        shape = (210, 260)
+    print()
 
-        out = cv2.VideoWriter(video_path, fourcc, 25.0, shape)
-        for im in image_paths:
-            frame = cv2.imread(im)
-            out.write(frame)
 
-        out.release()
-        pp.show(idx)
+def benchmark_ph_frame_backends(split="dev", n_videos=20):
+    # frames/s of reading whole PHOENIX videos from the converted videos and from the png folders
+    df = get_split_df(split)
+    rows = [df.iloc[idx] for idx in range(min(n_videos, df.shape[0]))]
 
-    pp.end()
+    for backend in ["video", "png"]:
+        video_paths = [get_ph_video_path(row, split, backend) for row in rows]
+        video_paths = [path for path in video_paths if get_video_len(path) > 0]
+        if not video_paths:
+            print(backend, "frames not found")
+            continue
 
-    print()
+        start_time = time.time()
+        n_frames = 0
+        for video_path in video_paths:
+            n_frames += len(get_images(video_path))
+        read_time = time.time() - start_time
+
+        print(backend, len(video_paths), "videos,", n_frames, "frames:",
+              "%.1f frames/s" % (n_frames / max(read_time, 1e-6)))
 
 
 def get_foreground_coords(frame):
@@ -72,100 +121,154 @@ def get_foreground_coords(frame):
     return None
 
 
-def resize_images(images):
-    h, w = images[-1].shape[:2]
+def get_out_size(h, w):
+    # output (w, h) of KRSL videos by aspect ratio: landscape, portrait or square
     ratio = w / h - 1
 
     if ratio > 0.3:
-        new_w = 360
-        new_h = 200
+        return 360, 200
     elif ratio < - 0.2:
-        new_w = 200
-        new_h = 360
+        return 200, 360
     else:
-        new_w = 200
-        new_h = 200
+        return 200, 200
+
+
+# foreground crop of every (signer, width, height) seen by this process, recordings of one signer setup
+# share the framing, so the contour search runs once per setup instead of once per video
+_crop_cache = {}
+
+
+def get_crop_key(video_path, w, h):
+    # KRSL names: P{signer}_S{sentence}_{repetition}.mp4, None => not cached
+    name = os.path.split(video_path)[1]
+    signer = name.split("_")[0]
+    if len(signer) < 2 or signer[0] != "P" or not signer[1:].isdigit():
+        return None
 
-    for i in range(len(images)):
-        images[i] = cv2.resize(images[i], (new_w, new_h))
+    return int(signer[1:]), w, h
 
-    return images
 
+def crop_matches(frame, coords):
+    # cheap check of a cached crop on a frame: background just outside the crop, foreground on its edges
+    y1, y2, x1, x2 = coords
+    fg = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) > 0
+    h, w = fg.shape
 
-def get_images(video):
-    cap = cv2.VideoCapture(video)
-    w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    inner = [fg[y1, x1:x2], fg[y2 - 1, x1:x2], fg[y1:y2, x1], fg[y1:y2, x2 - 1]]
+    outer = [fg[y1 - 1, x1:x2] if y1 > 0 else None,
+             fg[y2, x1:x2] if y2 < h else None,
+             fg[y1:y2, x1 - 1] if x1 > 0 else None,
+             fg[y1:y2, x2] if x2 < w else None]
+    outer = [edge for edge in outer if edge is not None]
+
+    return all(edge.mean() > 0.25 for edge in inner) and all(edge.mean() < 0.05 for edge in outer)
+
+
+def open_cropped_video(video_path, n_probe=10):
+    # Streams the frames of a KRSL video cropped to the foreground found in (at most) its first n_probe frames.
+    # Frames read before the foreground was found are dropped, without a foreground nothing is cropped.
+    # A cached crop of the same signer setup replaces the contour search on frames it fits.
+    # Returns (frames generator, number of frames it yields, fps), generator is None for videos without frames.
+    cap = cv2.VideoCapture(video_path)
     fps = int(cap.get(cv2.CAP_PROP_FPS))
+    key = get_crop_key(video_path, int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
 
     coords = None
-    images = []
-    finished = False
+    n_dropped = 0
+    first = []
 
-    coords_count = {}
-    for i in range(10):
+    for i in range(n_probe):
         ret, frame = cap.read()
         if not ret:
-            finished = True
             break
 
-        if not coords:
-            coords = get_foreground_coords(frame)
-            if coords:
-                coords_count[coords] = coords_count.get(coords, 0) + 1
+        if coords is None:
+            if key in _crop_cache and crop_matches(frame, _crop_cache[key]):
+                coords = _crop_cache[key]
+            else:
+                coords = get_foreground_coords(frame)
+
+            if coords is not None:
+                n_dropped = len(first)
+                first = []
+                if key is not None:
+                    _crop_cache[key] = coords
 
-        if coords:
+        if coords is not None:
             frame = frame[coords[0]:coords[1], coords[2]: coords[3]]
 
-        images.append(frame)
-
-    max_count = 0
-    for coord in coords_count:
-        if coords_count[coord] > max_count:
-            max_count = coords_count[coord]
-            coords = coord
-
-    if coords is not None:
-        new_w = coords[3] - coords[2]
-        new_h = coords[1] - coords[0]
-        i = 0
-        while (i < len(images)):
-            if (images[i].shape[:2] == (h, w)):
-                del images[i]
-                continue
-            if (images[i].shape[:2] != (new_h, new_w)):
-                images[i] = cv2.resize(images[i], (new_w, new_h))
-            i += 1
-
-        w, h = new_w, new_h
-
-    if not finished:
+        first.append(frame)
+
+    if not first:
+        cap.release()
+        return None, 0, fps
+
+    def frames_gen():
+        for frame in first:
+            yield frame
+
         while True:
             ret, frame = cap.read()
             if not ret:
                 break
 
-            if coords:
+            if coords is not None:
                 frame = frame[coords[0]:coords[1], coords[2]: coords[3]]
 
-            images.append(frame)
+            yield frame
 
-    cap.release()
-    return images, fps
+        cap.release()
+
+    return frames_gen(), get_video_len(video_path) - n_dropped, fps
+
+
+def reformat_KRSL_video(video_path, fps_out=25):
+    # 0 => reformatted, 1 => already there, 2 => no frames
+    out_video_path = os.sep.join([VIDEOS_DIR] + video_path.split(os.sep)[-2:])
+    if os.path.exists(out_video_path):
+        return 1
+
+    frames, L, fps = open_cropped_video(video_path)
+    if frames is None or L < 1:
+        return 2
+
+    # resampled to fps_out on the fly: output frame j is input frame round(j * L / L_out),
+    # counts[k] is how many times input frame k is written
+    L_out = round(L * fps_out / fps) if fps > 0 else L
+    src_idxs = np.minimum(np.round(np.linspace(0, L, L_out, endpoint=False)).astype(np.int64), L - 1)
+    counts = np.bincount(src_idxs, minlength=L)
+
+    video_dir = os.path.split(out_video_path)[0]
+    if not os.path.exists(video_dir):
+        os.makedirs(video_dir, exist_ok=True)
+
+    def resampled_frames():
+        out_size = None
+        for k, frame in enumerate(frames):
+            if k >= L:
+                break
+
+            if out_size is None:
+                out_size = get_out_size(*frame.shape[:2])
+
+            if counts[k]:
+                frame = cv2.resize(frame, out_size)
+                for _ in range(counts[k]):
+                    yield frame
+
+    return 0 if write_video(out_video_path, resampled_frames(), 'mp4v', float(fps_out)) else 2
 
 
 def clean_anno_KRSL(split, save=True):
     df = get_split_df(split)
     L = df.shape[0]
-    to_remove = []
-    for i in range(L):
-        row = df.iloc[i]
+    video_paths = [get_video_path(df.iloc[i], split)[0] for i in range(L)]
 
-        video_path, _ = get_video_path(row, split)
-        if not os.path.exists(video_path):
-            to_remove.append(i)
+    # stat calls only, threads are enough
+    with ThreadPoolExecutor(32) as executor:
+        exists = list(executor.map(os.path.exists, video_paths))
 
-    df = df.drop(df.index[to_remove])
+    df = df[np.array(exists, dtype=bool)]
     if save:
         df.to_csv(os.path.join(ANNO_DIR, split + ".csv"), index=None)
 
@@ -178,58 +281,42 @@ def reformat_KRSL():
 
     videos = list(glob.glob(os.sep.join([krsl_video_dir, "**", "*.mp4"])))
 
-    fps_out = 25
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-
+    # ordered by signer and handed out in chunks, so a worker mostly gets videos of one signer setup
+    # and its crop cache hits
     np.random.shuffle(videos)
+    videos = sorted(videos, key=lambda video_path: os.path.split(video_path)[1].split("_")[0])
     pp = ProgressPrinter(len(videos), 15)
 
     print("Reformatting KRSL")
 
     not_images = 0
-    for idx, video_path in enumerate(videos):
-        out_video_path = os.sep.join([VIDEOS_DIR] + video_path.split(os.sep)[-2:])
-        video_dir = os.path.split(out_video_path)[0]
-        if (os.path.exists(out_video_path)):
-            pp.omit()
-            continue
-
-        images, fps = get_images(video_path)
-
-        if not images:
-            not_images += 1
-            pp.omit()
-            continue
-
-        images = resize_images(images)
-
-        L = len(images)
-
-        L_out = round(L * fps_out / fps)
-
-        images = np.array(images)
-
-        idxs = np.linspace(0, L, L_out, endpoint=False)
-
-        hw = images.shape[1:3]
-        assert (hw == (200, 360) or hw == (200, 200) or hw == (360, 200))
-        images = [images[round(i)] for i in idxs]
-
-        if not os.path.exists(video_dir):
-            os.makedirs(video_dir)
+    with Pool(REFORMAT_WORKERS) as pool:
+        for idx, status in enumerate(pool.imap_unordered(reformat_KRSL_video, videos, chunksize=16)):
+            if status == 2:
+                not_images += 1
+
+            if status:
+                pp.omit()
+            else:
+                pp.show(idx)
+    pp.end()
 
-        out = cv2.VideoWriter(out_video_path, fourcc, 25.0, hw[::-1])
-        for frame in images:
-            out.write(frame)
+    if not_images:
+        print(not_images, "videos without frames")
 
-        out.release()
-        pp.show(idx)
-    pp.end()
     clean_anno_KRSL("train", save=True)
     clean_anno_KRSL("test", save=True)
     clean_anno_KRSL("dev", save=True)
 
 
 if __name__ == "__main__":
-    # convert_phoenix_to_videos()
-    reformat_KRSL()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--benchmark", action="store_true",
+                        help="only compare PHOENIX frame reading from the videos and the png folders")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark_ph_frame_backends()
+    else:
+        # convert_phoenix_to_videos()
+        reformat_KRSL()
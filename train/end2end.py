@@ -1,7 +1,6 @@
 import torch
 import torch.nn as nn
 import numpy as np
-import Levenshtein as Lev
 import pickle
 from torch.optim import Adam
 from torch.optim.lr_scheduler import ReduceLROnPlateau
@@ -10,7 +9,10 @@ import sys
 sys.path.append("..")
 from utils import ProgressPrinter
 from vocab import Vocab, predict_glosses
-from dataset import get_end2end_datasets
+from decoder import get_decoder
+from wer import WerAccumulator, score_ph_split
+from train.eval import evaluate_split
+from dataset import get_end2end_datasets, BatchPrefetcher
 from models import get_end2end_model, STF_2D
 from config import *
 
@@ -77,6 +79,8 @@ def train_end2end(model, vocab, datasets, use_feat):
     lr_scheduler = ReduceLROnPlateau(optimizer, factor=0.2, patience=4)
 
     best_wer = get_best_wer()
+    # beam search (END2END_DECODER) only scores the val phase, train WER stays greedy
+    decoder = get_decoder(vocab)
     curve = {"train": [], "val": []}
 
     current_best_wer = float("inf")
@@ -94,21 +98,21 @@ def train_end2end(model, vocab, datasets, use_feat):
 
                 dataset = datasets[phase]
                 n_batches = dataset.start_epoch()
+                print("   ", phase.upper(), "padding efficiency: %.1f%%" % (dataset.padding_efficiency * 100))
                 losses = []
-                hypes = []
-                gts = []
+                wer_acc = WerAccumulator()
 
                 with torch.set_grad_enabled(phase == "train"):
                     pp = ProgressPrinter(n_batches, 25 if USE_ST_FEAT else 1)
-                    for i in range(n_batches):
+                    for i, (X_batch, Y_batch, Y_lens, X_lens) in enumerate(BatchPrefetcher(dataset, n_batches)):
                         optimizer.zero_grad()
-                        X_batch, Y_batch, Y_lens = dataset.get_batch(i)
                         X_batch = X_batch.to(DEVICE)
                         Y_batch = Y_batch.to(DEVICE)
 
-                        preds = model(X_batch).log_softmax(dim=2)
+                        preds = model(X_batch, X_lens).log_softmax(dim=2)
                         T, N, V = preds.shape
-                        X_lens = torch.full(size=(N,), fill_value=T, dtype=torch.int32)
+                        # true CTC input lengths, the padded steps of shorter videos are not scored
+                        X_lens = torch.clamp(model.get_out_lengths(X_lens), 1, T).int()
                         loss = loss_fn(preds, Y_batch, X_lens, Y_lens)
                         losses.append(loss.item())
 
@@ -116,11 +120,10 @@ def train_end2end(model, vocab, datasets, use_feat):
                             loss.backward()
                             optimizer.step()
 
-                        out_sentences = predict_glosses(preds, decoder=None)
-                        gts += [y for y in Y_batch.view(-1).tolist() if y != 0]
-
-                        for sentence in out_sentences:
-                            hypes += sentence
+                        phase_decoder = decoder if phase == "val" else None
+                        out_sentences = predict_glosses(preds, decoder=phase_decoder, x_lens=X_lens)
+                        refs = [y[:y_len] for y, y_len in zip(Y_batch.tolist(), Y_lens.tolist())]
+                        wer_acc.update_batch(out_sentences, refs)
 
                         if i == 0 and SHOW_EXAMPLE:
                             pred = " ".join(vocab.decode(out_sentences[0]))
@@ -134,21 +137,23 @@ def train_end2end(model, vocab, datasets, use_feat):
                     if SHOW_PROGRESS:
                         pp.end("    ")
 
-                hypes = "".join([chr(x) for x in hypes])
-                gts = "".join([chr(x) for x in gts])
-                phase_wer = Lev.distance(hypes, gts) / len(gts) * 100
+                phase_wer = wer_acc.wer()
 
                 if phase == "train":
                     lr_scheduler.step(phase_wer)
 
                 curve[phase].append(phase_wer)
                 phase_loss = np.mean(losses)
-                print("   ", phase.upper(), "WER:", phase_wer, "Loss:", phase_loss)
+                print("   ", phase.upper(), wer_acc.summary(), "Loss:", phase_loss)
 
                 if phase_wer < best_wer[phase]:
                     best_wer[phase] = phase_wer
                     save_end2end_model(model, phase, best_wer[phase])
 
+                    if phase == "val" and END2END_SCORE_CHECKPOINTS and SOURCE == "PH":
+                        evaluate_split(model, vocab, "dev", decoder, use_cache=False)
+                        score_ph_split("dev")
+
                 if phase == "val":
                     if phase_wer < current_best_wer:
                         current_best_wer = phase_wer
@@ -163,6 +168,12 @@ def train_end2end(model, vocab, datasets, use_feat):
     except KeyboardInterrupt:
         pass
 
+    if decoder is not None:
+        decoder.close()
+
+    for dataset in datasets.values():
+        dataset.close()
+
     if epoch >= END2END_N_EPOCHS:
         trained = True
 
@@ -1,100 +1,139 @@
+import time
 import torch
 import sys
 
 sys.path.append("..")
 from config import *
 from models import get_end2end_model
-from vocab import Vocab
-from utils import ProgressPrinter, get_split_df, get_video_path
-import Levenshtein as Lev
+from vocab import Vocab, greedy_decode
+from decoder import get_decoder
+from dataset import get_end2end_dataset, BatchPrefetcher
+from emissions import EmissionCache, get_model_hash, get_emission_key, pad_emissions
+from utils import ProgressPrinter
+from wer import WerAccumulator, score_ph_split
 
 
-def eval_split_by_lev(model, vocab, split):
-    df = get_split_df(split)
-    pp = ProgressPrinter(df.shape[0], 5)
-    hypes = []
-    gts = []
-    with torch.no_grad():
-        for idx in range(df.shape[0]):
-            row = df.iloc[idx]
-            gt = vocab.encode(row.annotation)
-            video_path, feat_path = get_video_path(row, split)
-            tensor_video = torch.load(feat_path).unsqueeze(0).to(DEVICE)
-            pred = model(tensor_video).squeeze(1).log_softmax(dim=1).argmax(dim=1).cpu().numpy()
-
-            hypo = []
-            for i in range(len(pred)):
-                if pred[i] == 0 or (i > 0 and pred[i] == pred[i - 1]):
-                    continue
-                hypo.append(pred[i])
-
-            gts += gt
-            hypes += hypo
-            pp.show(idx)
+def decode_prediction(preds, x_lens=None, decoder=None):
+    # (T, N, V) log probabilities => per sequence: gloss indices, start times and durations in seconds,
+    # beam search hypotheses (decoder) only know where their glosses start, they last one step
+    step = 4
+    decoded = []
+    if decoder:
+        probs = preds.permute(1, 0, 2).softmax(dim=2)
+        beam_result, beam_scores, timesteps, out_seq_len = decoder.decode(probs, x_lens)
+        for i in range(probs.size(0)):
+            L = int(out_seq_len[i][0])
+            start_times = list(timesteps[i][0][:L].numpy() * step / 25)
+            decoded.append((beam_result[i][0][:L].tolist(), start_times, [step / 25] * L))
 
-        pp.end()
+        return decoded
 
-        hypes = "".join([chr(x) for x in hypes])
-        gts = "".join([chr(x) for x in gts])
-        wer = Lev.distance(hypes, gts) / len(gts) * 100
+    tokens, offsets, starts, durations = greedy_decode(preds, x_lens)
+    for idx in range(len(offsets) - 1):
+        s, e = offsets[idx], offsets[idx + 1]
+        decoded.append((tokens[s:e].tolist(), list(starts[s:e] * step / 25), list(durations[s:e] * step / 25)))
 
-        print(wer)
+    return decoded
 
 
-def decode_prediction(pred, vocab):
-    out_sentence = []
-    start_times = []
-    durations = []
+def get_utterance_id(path):
+    # PHOENIX features and videos are named after the video folder, the id in the .stm/.ctm files,
+    # frame globs (PH_FRAME_BACKEND = "png") end in that folder + "/1/*.png"
+    if path.endswith("/1/*.png"):
+        path = path[:-len("/1/*.png")]
 
-    step = 4
-    for i in range(len(pred)):
-        if pred[i] == 0:
-            continue
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def get_batch_emissions(model, dataset, n_batches, keys, cache):
+    # (batch idx, (T, N, V) log probabilities, output lengths, references) of every batch,
+    # from the emission cache when it holds the whole split, the model otherwise (filling the cache)
+    if cache is not None and all(key in cache for key in keys):
+        print(dataset.split, "emissions cached, the model is skipped")
+        for i in range(n_batches):
+            preds, out_lens = pad_emissions([cache.get(keys[idx]) for idx in dataset.batches[i]])
+            yield i, preds, out_lens, [dataset.Y[idx].tolist() for idx in dataset.batches[i]]
+
+        return
 
-        if (i > 0 and pred[i] == pred[i - 1]):
-            durations[-1] += step / 25
-        else:
+    for i, (X_batch, Y_batch, Y_lens, X_lens) in enumerate(BatchPrefetcher(dataset, n_batches)):
+        preds = model(X_batch.to(DEVICE), X_lens).log_softmax(dim=2)
+        out_lens = torch.clamp(model.get_out_lengths(X_lens), 1, preds.size(0)).cpu()
+        if cache is not None:
+            for b, idx in enumerate(dataset.batches[i]):
+                cache.put(keys[idx], preds[:out_lens[b], b])
 
-            durations.append(step / 25)
-            start_times.append(i * step / 25)
-            out_sentence.append(vocab.idx2gloss[pred[i]])
+        yield i, preds, out_lens, [y[:y_len] for y, y_len in zip(Y_batch.tolist(), Y_lens.tolist())]
 
-    return out_sentence, start_times, durations
 
+def evaluate_split(model, vocab, split, decoder=None, write_ctm=SOURCE == "PH", use_cache=EMISSION_CACHE):
+    # One pass over the split: utterances batched by length (zero padded, true lengths passed to the model),
+    # every batch output goes to WER scoring, the .ctm file (PH_EVA_DIR) and the emission cache (emissions.py).
+    start_time = time.time()
+    dataset = get_end2end_dataset(model, vocab, split)
+    split = dataset.split
+    n_batches = dataset.start_epoch(shuffle=False)
 
-def create_ctm_file_split(model, vocab, split):
-    gt_ctm_val_file = os.sep.join([PH_EVA_DIR, "phoenix2014-groundtruth-" + split + ".stm"])
+    cache = None
+    keys = None
+    if use_cache:
+        cache = EmissionCache(get_model_hash(model), split)
+        keys = [get_emission_key(path, dataset.store_path) for path in dataset.X]
 
-    with open(gt_ctm_val_file, 'r') as f:
-        lines = f.readlines()
+    wer_acc = WerAccumulator()
+    ctm_lines = {}
 
-    dirs = []
-    for line in lines:
-        dirs.append(line.split(" ")[0])
+    pp = ProgressPrinter(n_batches, 5)
+    with torch.no_grad():
+        for i, preds, out_lens, refs in get_batch_emissions(model, dataset, n_batches, keys, cache):
+            decoded = decode_prediction(preds, out_lens, decoder)
+
+            for b, (idx, (hypo, start_times, durations)) in enumerate(zip(dataset.batches[i], decoded)):
+                wer_acc.update(hypo, refs[b])
 
-    out_ctm_path = STF_MODEL + "_" + split + ".ctm"
-    with open(os.sep.join([PH_EVA_DIR, out_ctm_path]), 'w') as f:
-        with torch.no_grad():
-            for idx, dir in enumerate(dirs):
-                feat_path = os.sep.join([STF_FEAT_DIR, split, dir + ".pt"])
-                inp = torch.load(feat_path).to(DEVICE).unsqueeze(0)
+                if write_ctm:
+                    utt_id = get_utterance_id(dataset.X[idx])
+                    ctm_lines[idx] = [" ".join([utt_id, "1", "%.3f" % start_time, "%.3f" % duration,
+                                                vocab.idx2gloss[gloss]])
+                                      for gloss, start_time, duration in zip(hypo, start_times, durations)]
 
-                pred = model(inp)
+            if SHOW_PROGRESS:
+                pp.show(i)
+
+    if SHOW_PROGRESS:
+        pp.end()
 
-                pred = pred.squeeze(1).log_softmax(dim=1).argmax(dim=1).cpu().numpy()
+    if write_ctm:
+        if not os.path.exists(PH_EVA_DIR):
+            os.makedirs(PH_EVA_DIR)
 
-                out_sentence, start_times, durations = decode_prediction(pred, vocab)
+        # in the order of the split's annotation
+        with open(os.sep.join([PH_EVA_DIR, STF_MODEL + "_" + split + ".ctm"]), 'w') as f:
+            for idx in sorted(ctm_lines):
+                for line in ctm_lines[idx]:
+                    f.write(line + os.linesep)
 
-                for gloss, start_time, duration in zip(out_sentence, start_times, durations):
-                    f.write(" ".join([dir, "1", "%.3f" % start_time, "%.3f" % duration, gloss]) + os.linesep)
+    dataset.close()
+    if cache is not None:
+        cache.save()
+
+    eval_time = time.time() - start_time
+    print(split, wer_acc.summary())
+    print(split, "evaluated", wer_acc.n_utts, "utterances in %.1fs" % eval_time,
+          "(%.1f utterances/s)" % (wer_acc.n_utts / max(eval_time, 1e-6)))
+
+    return wer_acc
 
 
 if __name__ == "__main__":
     vocab = Vocab()
     model, loaded = get_end2end_model(vocab, True, 1, True)
     model.eval()
-    with torch.no_grad():
-        create_ctm_file_split(model, vocab, "dev")
-        eval_split_by_lev(model, vocab, "dev")
-        create_ctm_file_split(model, vocab, "test")
-        eval_split_by_lev(model, vocab, "test")
+    decoder = get_decoder(vocab)
+    for split in ["dev", "test"]:
+        evaluate_split(model, vocab, split, decoder)
+        if SOURCE == "PH":
+            score_ph_split(split, n_worst=10)
+
+    if decoder is not None:
+        decoder.close()
@@ -1,6 +1,8 @@
 import time
 from config import *
+import numpy as np
 import pandas as pd
+import torch
 import os
 
 
@@ -54,10 +56,18 @@ def get_split_df(split):
     return df
 
 
+def get_ph_video_path(row, split, backend=PH_FRAME_BACKEND):
+    # "png" => glob pattern of the original frames, read directly by processing_tools.get_images
+    if backend == "png":
+        return os.sep.join([PH_DIR, "features", "fullFrame-210x260px", split, row.folder])
+
+    return os.sep.join([VIDEOS_DIR, split, row.folder.replace("/1/*.png", PH_VIDEO_EXT)])
+
+
 def get_video_path(row, split, stf_feat=True, feat_ext=".pt"):
     feat_dir = STF_FEAT_DIR if stf_feat else IMG_FEAT_DIR
     if SOURCE == "PH":
-        video_path = os.sep.join([VIDEOS_DIR, split, row.folder.replace("/1/*.png", ".mp4")])
+        video_path = get_ph_video_path(row, split)
         feat_path = os.sep.join([feat_dir, split, row.folder.replace("/1/*.png", feat_ext)])
     elif SOURCE == "KRSL":
         video_path = os.path.join(VIDEOS_DIR, row.video)
@@ -69,6 +79,44 @@ def get_video_path(row, split, stf_feat=True, feat_ext=".pt"):
     return video_path, feat_path
 
 
+def get_feat_shape(feat_path):
+    # shape of a saved feature array, read from the file header without loading the data
+    if feat_path.endswith(".npy"):
+        with open(feat_path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                return np.lib.format.read_array_header_1_0(f)[0]
+            return np.lib.format.read_array_header_2_0(f)[0]
+
+    try:
+        # memory-mapped load only unpickles the tensor metadata (torch >= 2.1, zip serialization)
+        return tuple(torch.load(feat_path, map_location="cpu", mmap=True).shape)
+    except (TypeError, RuntimeError):
+        return tuple(torch.load(feat_path, map_location="cpu").shape)
+
+
+def atomic_save(path, save_fn):
+    # save_fn(f) writes into an open file, readers never see a half written file under path
+    out_dir = os.path.split(path)[0]
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        save_fn(f)
+    os.replace(tmp_path, path)
+
+
+def get_packed_feats_path(split, stf_feat=True):
+    feat_dir = STF_FEAT_DIR if stf_feat else IMG_FEAT_DIR
+    return os.sep.join([feat_dir, "PACKED", split])
+
+
+def get_frame_store_path(split, stf_type=STF_TYPE):
+    img_size = IMG_SIZE_2D if stf_type == 0 else IMG_SIZE_2Plus1D
+    return os.sep.join([FRAME_STORE_DIR, str(img_size), split])
+
+
 def check_stf_features(img_feat=False):
     print(SOURCE, STF_MODEL, "checking features...")
     for split in ["train", "dev", "test"]:
@@ -1,3 +1,5 @@
+import numpy as np
+import torch
 from config import *
 
 
@@ -70,59 +72,94 @@ class Vocab(object):
         return [self.decode(vectors) for vectors in vectors_seq]
 
 
-def min_dist_transform(hypo, gt):
-    dp = [[None for _ in range(len(gt) + 1)] for _ in range(len(hypo) + 1)]
-
-    def ed(i, j):
-        if dp[i + 1][j + 1] is not None:
-            return dp[i + 1][j + 1]
-
-        if i == -1 and j == -1:
-            dp[0][0] = []
-            return []
-
-        if i == -1:
-            # insert
-            dp[0][j] = ed(-1, j - 1)
-            dp[0][j + 1] = ["ins_0_" + str(gt[j])] + dp[i + 1][j]
-
-            return dp[0][j + 1]
+# edit operations of min_dist_transform_batch: rows of (op, hypo index, gt label)
+OP_DEL = 1
+OP_INS = 2
+OP_REP = 3
+
+
+def min_dist_transform_batch(hypos, gts):
+    # Minimum edit transformations of every hypo into its gt, all pairs at once.
+    # Costs and backpointers (0 match, 1 del, 2 ins, 3 rep) are filled one anti-diagonal i + j = d at a time,
+    # vectorized over the diagonal and the batch. Equal labels always match; otherwise ties prefer del, then ins,
+    # then rep. Each result is an int array of (op, idx, label) rows ordered from the end of the hypo to its start,
+    # so they can be applied in order (indices as in the hypo before any of them is applied):
+    #   (OP_DEL, i, 0) deletes hypo[i], (OP_INS, i, l) inserts l before hypo[i], (OP_REP, i, l) sets hypo[i] = l
+    B = len(hypos)
+    hypo_lens = np.array([len(hypo) for hypo in hypos], dtype=np.int64)
+    gt_lens = np.array([len(gt) for gt in gts], dtype=np.int64)
+    n = max(hypo_lens.max(initial=0), 1)
+    m = max(gt_lens.max(initial=0), 1)
+
+    # different pads, padding never matches
+    H = np.full((B, n), -1, dtype=np.int64)
+    G = np.full((B, m), -2, dtype=np.int64)
+    for b in range(B):
+        H[b, :hypo_lens[b]] = hypos[b]
+        G[b, :gt_lens[b]] = gts[b]
+
+    C = np.zeros((B, n + 1, m + 1), dtype=np.int64)
+    P = np.zeros((B, n + 1, m + 1), dtype=np.int8)
+    C[:, :, 0] = np.arange(n + 1)
+    C[:, 0, :] = np.arange(m + 1)
+    P[:, 1:, 0] = OP_DEL
+    P[:, 0, 1:] = OP_INS
+
+    for d in range(2, n + m + 1):
+        i = np.arange(max(1, d - m), min(n, d - 1) + 1)
+        j = d - i
+
+        rep = C[:, i - 1, j - 1]
+        best = C[:, i - 1, j]
+        op = np.full(best.shape, OP_DEL, dtype=np.int8)
+
+        ins = C[:, i, j - 1]
+        better = ins < best
+        best = np.where(better, ins, best)
+        op[better] = OP_INS
+
+        better = rep < best
+        best = np.where(better, rep, best)
+        op[better] = OP_REP
+
+        match = H[:, i - 1] == G[:, j - 1]
+        C[:, i, j] = np.where(match, rep, best + 1)
+        P[:, i, j] = np.where(match, 0, op)
+
+    transforms = []
+    for b in range(B):
+        ops = []
+        i, j = hypo_lens[b], gt_lens[b]
+        while i > 0 or j > 0:
+            op = P[b, i, j]
+            if op == OP_DEL:
+                ops.append((OP_DEL, i - 1, 0))
+                i -= 1
+            elif op == OP_INS:
+                ops.append((OP_INS, i, G[b, j - 1]))
+                j -= 1
+            else:
+                if op == OP_REP:
+                    ops.append((OP_REP, i - 1, G[b, j - 1]))
+                i -= 1
+                j -= 1
 
-        if j == -1:
-            # delete
-            dp[i][0] = ed(i - 1, -1)
+        transforms.append(np.array(ops, dtype=np.int64).reshape(-1, 3))
 
-            dp[i + 1][0] = ["del_" + str(i)] + dp[i][0]
+    return transforms
 
-            return dp[i + 1][0]
 
-        if hypo[i] == gt[j]:
-            dp[i + 1][j + 1] = ed(i - 1, j - 1)
-            return dp[i + 1][j + 1]
+def min_dist_transform(hypo, gt):
+    # single pair version, operations as "del_i", "ins_i_label" and "rep_i_label" strings
+    names = {OP_DEL: "del", OP_INS: "ins", OP_REP: "rep"}
+    transform = []
+    for op, idx, val in min_dist_transform_batch([hypo], [gt])[0]:
+        if op == OP_DEL:
+            transform.append("del_" + str(idx))
         else:
-            # del
-            dp[i][j + 1] = ed(i - 1, j)
-            opt = dp[i][j + 1]
-            des = "del_" + str(i)
-
-            # ins
-            dp[i + 1][j] = ed(i, j - 1)
-            if len(dp[i + 1][j]) < len(opt):
-                opt = dp[i + 1][j]
-                des = "ins_" + str(i + 1) + "_" + str(gt[j])
+            transform.append(names[op] + "_" + str(idx) + "_" + str(val))
 
-            # rep
-            dp[i][j] = ed(i - 1, j - 1)
-
-            if len(dp[i][j]) < len(opt):
-                opt = dp[i][j]
-                des = "rep_" + str(i) + "_" + str(gt[j])
-
-            dp[i + 1][j + 1] = [des] + opt
-
-            return dp[i + 1][j + 1]
-
-    return ed(len(hypo) - 1, len(gt) - 1)
+    return transform
 
 
 def force_alignment(pred, gt):
@@ -142,18 +179,13 @@ def force_alignment(pred, gt):
 
         s = i + 1
 
-    transform = min_dist_transform(hypo, gt)
+    transform = min_dist_transform_batch([hypo], [gt])[0]
 
-    for oper in transform:
-        oper = oper.split("_")
-        des = oper[0]
-        idx = int(oper[1])
-        val = int(oper[-1])
-
-        if des == "del":
+    for des, idx, val in transform.tolist():
+        if des == OP_DEL:
             del hypo[idx]
             del hypo_idxs[idx]
-        elif des == "ins":
+        elif des == OP_INS:
             if idx > 0 and idx < len(hypo) - 1:
                 s1, e1 = hypo_idxs[idx - 1]
                 s2, e2 = hypo_idxs[idx]
@@ -205,25 +237,116 @@ def force_alignment(pred, gt):
     return pred
 
 
-def predict_glosses(preds, decoder):
+def ctc_forced_align(log_probs, lengths, targets, blank=0):
+    # CTC Viterbi alignment of a padded batch: log_probs (B, T, V), lengths (B,) valid steps, targets gloss lists.
+    # Over the blank-extended targets [blank, y1, blank, y2, ..., yL, blank] the best path is found step by step
+    # for all utterances and states at once. Returns per utterance the label of each of its steps (blank = 0),
+    # None where the glosses don't fit into its steps (e.g. more glosses than steps).
+    B, T, V = log_probs.shape
+    device = log_probs.device
+    L = max([len(y) for y in targets] + [1])
+    S = 2 * L + 1
+
+    ext = torch.full((B, S), blank, dtype=torch.long)
+    skip = torch.zeros((B, S), dtype=torch.bool)
+    for b, y in enumerate(targets):
+        if len(y) > 0:
+            y = torch.as_tensor(y, dtype=torch.long)
+            ext[b, 1:2 * len(y):2] = y
+            # a blank can be skipped between two different glosses only
+            skip[b, 3:2 * len(y):2] = y[1:] != y[:-1]
+
+    ext = ext.to(device)
+    skip = skip.to(device)
+    lengths = torch.as_tensor(lengths).to(device)
+
+    emissions = log_probs.gather(2, ext[:, None, :].expand(B, T, S))
+    neg_inf = torch.full((B, 2), float("-inf"), device=device)
+
+    alpha = torch.full((B, S), float("-inf"), device=device)
+    alpha[:, :2] = emissions[:, 0, :2]
+    final = alpha.clone()
+    back = torch.zeros((B, T, S), dtype=torch.uint8, device=device)
+    for t in range(1, T):
+        prev1 = torch.cat([neg_inf[:, :1], alpha[:, :-1]], dim=1)
+        prev2 = torch.where(skip, torch.cat([neg_inf, alpha[:, :-2]], dim=1), neg_inf[:, :1])
+        alpha, back[:, t] = torch.stack([alpha, prev1, prev2], dim=2).max(dim=2)
+        alpha = alpha + emissions[:, t]
+
+        ended = lengths - 1 == t
+        final[ended] = alpha[ended]
+
+    final = final.cpu().numpy()
+    back = back.cpu().numpy()
+    ext = ext.cpu().numpy()
+    lengths = lengths.cpu().numpy()
+
+    alignments = []
+    for b, y in enumerate(targets):
+        # ends in the last gloss or the trailing blank
+        ends = [2 * len(y) - 1, 2 * len(y)] if len(y) > 0 else [0]
+        s = ends[int(np.argmax(final[b, ends]))]
+        if final[b, s] == float("-inf"):
+            alignments.append(None)
+            continue
+
+        alignment = np.zeros(lengths[b], dtype=np.int64)
+        for t in range(lengths[b] - 1, -1, -1):
+            alignment[t] = ext[b, s]
+            s -= back[b, t, s]
+
+        alignments.append(alignment)
+
+    return alignments
+
+
+def greedy_decode(preds, x_lens=None, blank=0):
+    # best path decoding of a whole (T, N, V) batch at once: a step starts a run where its argmax differs from
+    # the previous step, runs of non blank labels are the tokens.
+    # Returns numpy arrays: tokens of all sequences one after another, offsets (N + 1,) => tokens of sequence i are
+    # tokens[offsets[i]:offsets[i + 1]], starts and durations of the tokens' runs in time steps (for CTM files)
+    T, N = preds.shape[:2]
+    best = preds.argmax(dim=2).t()
+    if x_lens is None:
+        x_lens = torch.full((N,), T, dtype=torch.long, device=best.device)
+    else:
+        x_lens = torch.as_tensor(x_lens).to(best.device).long()
+
+    valid = torch.arange(T, device=best.device)[None] < x_lens[:, None]
+    run_start = torch.ones_like(valid)
+    run_start[:, 1:] = best[:, 1:] != best[:, :-1]
+
+    rows, steps = torch.nonzero(run_start & valid, as_tuple=True)
+    labels = best[rows, steps]
+
+    # a run lasts until the next run of its sequence or the sequence end
+    ends = torch.roll(steps, -1)
+    last = torch.ones_like(rows, dtype=torch.bool)
+    last[:-1] = rows[1:] != rows[:-1]
+    ends[last] = x_lens[rows[last]]
+
+    keep = labels != blank
+    offsets = torch.zeros(N + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.bincount(rows[keep].cpu(), minlength=N), dim=0)
+
+    return labels[keep].cpu().numpy(), offsets.numpy(), steps[keep].cpu().numpy(), (ends - steps)[keep].cpu().numpy()
+
+
+def predict_glosses(preds, decoder, x_lens=None):
+    # x_lens: number of valid (unpadded) time steps of every prediction
     out_sentences = []
     if decoder:
-        # need to check decoder for permutations of predictions
-        beam_result, beam_scores, timesteps, out_seq_len = decoder.decode(preds)
-        for i in range(preds.size(0)):
-            hypo = list(beam_result[i][0][:out_seq_len[i][0]])
+        # (T, N, V) log probabilities => (N, T, V) probabilities as ctcdecode style decoders take them
+        probs = preds.permute(1, 0, 2).softmax(dim=2)
+        beam_result, beam_scores, timesteps, out_seq_len = decoder.decode(probs, x_lens)
+        for i in range(probs.size(0)):
+            hypo = beam_result[i][0][:out_seq_len[i][0]].tolist()
             out_sentences.append(hypo)
 
     else:
-        preds = preds.permute(1, 0, 2).argmax(dim=2).cpu().numpy()
-        # glosses_batch = vocab.decode_batch(preds)
-        for pred in preds:
-            hypo = []
-            for i in range(len(pred)):
-                if pred[i] == 0 or (i > 0 and pred[i] == pred[i - 1]):
-                    continue
-                hypo.append(pred[i])
-
-            out_sentences.append(hypo)
+        tokens, offsets = greedy_decode(preds, x_lens)[:2]
+        tokens = tokens.tolist()
+        for idx in range(len(offsets) - 1):
+            out_sentences.append(tokens[offsets[idx]:offsets[idx + 1]])
 
     return out_sentences
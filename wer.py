@@ -0,0 +1,207 @@
+import re
+import Levenshtein as Lev
+from config import *
+
+
+class WerAccumulator():
+    # running word error counts, every utterance is aligned with its own reference,
+    # accumulators of different batches/processes add up with merge
+    def __init__(self):
+        self.n_utts = 0
+        self.n_ref = 0
+        self.n_sub = 0
+        self.n_ins = 0
+        self.n_del = 0
+
+    def update(self, hypo, ref):
+        # hypo, ref: lists of gloss indices, returns the errors of this utterance
+        hypo = "".join([chr(x) for x in hypo])
+        ref = "".join([chr(x) for x in ref])
+
+        n_sub = n_ins = n_del = 0
+        for op, _, _ in Lev.editops(ref, hypo):
+            if op == "replace":
+                n_sub += 1
+            elif op == "insert":
+                n_ins += 1
+            else:
+                n_del += 1
+
+        self.add_counts(len(ref), n_sub, n_ins, n_del)
+        return n_sub + n_ins + n_del
+
+    def add_counts(self, n_ref, n_sub, n_ins, n_del):
+        # one utterance scored elsewhere
+        self.n_utts += 1
+        self.n_ref += n_ref
+        self.n_sub += n_sub
+        self.n_ins += n_ins
+        self.n_del += n_del
+
+    def update_batch(self, hypos, refs):
+        for hypo, ref in zip(hypos, refs):
+            self.update(hypo, ref)
+
+    def merge(self, other):
+        self.n_utts += other.n_utts
+        self.n_ref += other.n_ref
+        self.n_sub += other.n_sub
+        self.n_ins += other.n_ins
+        self.n_del += other.n_del
+        return self
+
+    def n_errors(self):
+        return self.n_sub + self.n_ins + self.n_del
+
+    def wer(self):
+        return self.n_errors() / max(self.n_ref, 1) * 100
+
+    def summary(self):
+        n_ref = max(self.n_ref, 1)
+        return "WER: %.2f%% (sub: %.2f%%, ins: %.2f%%, del: %.2f%%, %d utterances, %d glosses)" % (
+            self.wer(), self.n_sub / n_ref * 100, self.n_ins / n_ref * 100, self.n_del / n_ref * 100,
+            self.n_utts, self.n_ref)
+
+
+# PHOENIX scoring without sclite: the .ctm hypotheses and .stm references of PH_EVA_DIR are normalized like the
+# official evaluation script does and aligned with sclite's weights (substitution 4, insertion/deletion 3)
+
+PH_DROP_PREFIXES = ["loc-", "cl-", "qu-", "poss-", "lh-"]
+PH_REPLACE = {"S0NNE": "SONNE", "HABEN2": "HABEN", "ZEIGEN": "ZEIGEN-BILDSCHIRM"}
+PH_REMOVE = {"__EMOTION__", "__PU__", "__LEFTHAND__", "__EPENTHESIS__", "__ON__", "__OFF__"}
+# parts of fingerspelled words, joined with "+"
+PH_LETTERS = {"SCH", "NN"}
+
+
+def is_ph_letter(gloss):
+    return (len(gloss) == 1 and "A" <= gloss <= "Z") or gloss in PH_LETTERS
+
+
+def normalize_ph_glosses(glosses):
+    out = []
+    for gloss in glosses:
+        for prefix in PH_DROP_PREFIXES:
+            gloss = gloss.replace(prefix, "")
+
+        gloss = PH_REPLACE.get(gloss, gloss).replace("-PLUSPLUS", "")
+        gloss = re.sub(r"([A-Z][A-Z])RAUM", r"\1", gloss)
+
+        if gloss and gloss not in PH_REMOVE:
+            out.append(gloss)
+
+    glosses = out
+    out = []
+    for i, gloss in enumerate(glosses):
+        if out and gloss == "AUSSEHEN" and out[-1] == "WIE":
+            out[-1] = "WIE-AUSSEHEN"
+        elif out and is_ph_letter(gloss) and i > 0 and is_ph_letter(glosses[i - 1]):
+            out[-1] += "+" + gloss
+        elif out and gloss == out[-1] and re.fullmatch(r"[A-Z]+", gloss):
+            # repetitions of a plain gloss count once
+            continue
+        else:
+            out.append(gloss)
+
+    return out
+
+
+def align_errors(ref, hypo, w_sub=4, w_ins=3, w_del=3):
+    # (substitutions, insertions, deletions) of the min weighted cost alignment
+    n, m = len(ref), len(hypo)
+    # cost[j], errors[j] = (sub, ins, del) of aligning ref[:i] with hypo[:j]
+    cost = [j * w_ins for j in range(m + 1)]
+    errors = [(0, j, 0) for j in range(m + 1)]
+    for i in range(1, n + 1):
+        prev_cost, prev_errors = cost, errors
+        cost = [i * w_del] + [0] * m
+        errors = [(0, 0, i)] + [None] * m
+        for j in range(1, m + 1):
+            if ref[i - 1] == hypo[j - 1]:
+                best, best_errors = prev_cost[j - 1], prev_errors[j - 1]
+            else:
+                s, ins, d = prev_errors[j - 1]
+                best, best_errors = prev_cost[j - 1] + w_sub, (s + 1, ins, d)
+
+            if prev_cost[j] + w_del < best:
+                s, ins, d = prev_errors[j]
+                best, best_errors = prev_cost[j] + w_del, (s, ins, d + 1)
+
+            if cost[j - 1] + w_ins < best:
+                s, ins, d = errors[j - 1]
+                best, best_errors = cost[j - 1] + w_ins, (s, ins + 1, d)
+
+            cost[j], errors[j] = best, best_errors
+
+    return errors[m]
+
+
+def read_stm(stm_path):
+    # id => reference glosses, "<id> 1 <signer> <start> <end> <glosses...>" lines
+    refs = {}
+    with open(stm_path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 5 or line.startswith(";;"):
+                continue
+
+            refs[fields[0]] = fields[5:]
+
+    return refs
+
+
+def read_ctm(ctm_path):
+    # id => hypothesis glosses in order of start time, "<id> 1 <start> <duration> <gloss>" lines
+    hypos = {}
+    with open(ctm_path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 5:
+                continue
+
+            hypos.setdefault(fields[0], []).append((float(fields[2]), fields[4]))
+
+    return {utt_id: [gloss for start, gloss in sorted(glosses, key=lambda x: x[0])]
+            for utt_id, glosses in hypos.items()}
+
+
+def score_ctm(ctm_path, stm_path):
+    # Returns the aggregate WerAccumulator and per utterance (id, n_ref, n_sub, n_ins, n_del),
+    # utterances missing from the .ctm are empty hypotheses
+    refs = read_stm(stm_path)
+    hypos = read_ctm(ctm_path)
+
+    wer_acc = WerAccumulator()
+    utt_errors = []
+    for utt_id, ref in refs.items():
+        ref = normalize_ph_glosses(ref)
+        hypo = normalize_ph_glosses(hypos.get(utt_id, []))
+        n_sub, n_ins, n_del = align_errors(ref, hypo)
+        wer_acc.add_counts(len(ref), n_sub, n_ins, n_del)
+        utt_errors.append((utt_id, len(ref), n_sub, n_ins, n_del))
+
+    return wer_acc, utt_errors
+
+
+def get_ph_eval_paths(split, model_name=STF_MODEL):
+    # .ctm written by train/eval.evaluate_split, official .stm of the split
+    ctm_path = os.sep.join([PH_EVA_DIR, model_name + "_" + split + ".ctm"])
+    stm_path = os.sep.join([PH_EVA_DIR, "phoenix2014-groundtruth-" + split + ".stm"])
+    return ctm_path, stm_path
+
+
+def score_ph_split(split, model_name=STF_MODEL, n_worst=0):
+    ctm_path, stm_path = get_ph_eval_paths(split, model_name)
+    if not os.path.exists(stm_path) or not os.path.exists(ctm_path):
+        print("Can not score", split, "missing", stm_path if not os.path.exists(stm_path) else ctm_path)
+        return None
+
+    wer_acc, utt_errors = score_ctm(ctm_path, stm_path)
+    print(split, "PHOENIX", wer_acc.summary())
+
+    # utterances with the highest WER
+    worst = sorted(utt_errors, key=lambda x: (x[2] + x[3] + x[4]) / max(x[1], 1), reverse=True)[:n_worst]
+    for utt_id, n_ref, n_sub, n_ins, n_del in worst:
+        print("   ", utt_id, "WER: %.1f%%" % ((n_sub + n_ins + n_del) / max(n_ref, 1) * 100),
+              "sub:", n_sub, "ins:", n_ins, "del:", n_del, "ref:", n_ref)
+
+    return wer_acc